@@ -0,0 +1,138 @@
+import math
+import time
+import threading
+
+# ---------- COST-AWARE ADMISSION CONTROL ----------
+#
+# A generation's cost is counted in 512x512 denoising steps: an image costs
+# width * height * steps / (512 * 512), so one 150-step image weighs as much
+# as three 50-step ones. Admitted work stays "in flight" until its future
+# resolves, and the drain rate (cost units finished per busy second) is
+# learned from those completions. New work is turned away at once when it
+# would push the in-flight cost over the budget, or when the work already
+# admitted ahead of it would take more than max_wait to drain; the rejection
+# says how long the in-flight work needs to drain for the request to fit.
+
+UNIT_PIXELS = 512 * 512
+
+class AdmissionRejected(Exception):
+    """A request that cannot be admitted now; status is 429 or 503."""
+
+    def __init__(self, status, message, retry_after, estimated_wait):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+        self.estimated_wait = estimated_wait
+
+class AdmissionController:
+    """
+    Bounds the total cost of admitted, unfinished generations.
+    max_cost <= 0 disables the budget and max_wait <= 0 the wait limit.
+    default_rate (cost units per second) is used until completions are seen;
+    decay weighs older completions in the learned rate.
+    """
+
+    def __init__(self, max_cost=1600, max_wait=180, default_rate=4.0, decay=0.9):
+        self.max_cost = max_cost
+        self.max_wait = max_wait
+        self.default_rate = default_rate
+        self.decay = decay
+        self._lock = threading.Lock()
+        self._in_flight = 0.0
+        self._items = 0
+        self._drained_cost = 0.0
+        self._busy_seconds = 0.0
+        self._mark = time.monotonic()
+        self.admitted = 0
+        self.rejected = {429: 0, 503: 0}
+
+    @staticmethod
+    def cost(width, height, steps, count=1):
+        return width * height * steps * count / UNIT_PIXELS
+
+    def _rate(self):
+        if self._busy_seconds <= 0 or self._drained_cost <= 0:
+            return self.default_rate
+        return self._drained_cost / self._busy_seconds
+
+    def _check(self, cost):
+        """(status, message, retry_after, estimated_wait) for cost, status None if it fits."""
+        rate = self._rate()
+        estimated_wait = (self._in_flight + cost) / rate
+        excess = 0.0
+        status = message = None
+        if self.max_cost > 0 and self._in_flight + cost > self.max_cost:
+            excess = self._in_flight + cost - self.max_cost
+            status, message = 429, "Too much generation work in progress, try again later"
+        elif self.max_wait > 0 and self._in_flight / rate > self.max_wait:
+            excess = self._in_flight - self.max_wait * rate
+            status, message = 503, "Generation queue is too long, try again later"
+        return status, message, max(1, math.ceil(excess / rate)), estimated_wait
+
+    def admit(self, cost, items=1):
+        """
+        Reserves cost for items images, each later given back with release().
+        Returns the estimated seconds until the results.
+        Raises ValueError if cost can never fit, AdmissionRejected if it does not fit now.
+        """
+        if self.max_cost > 0 and cost > self.max_cost:
+            raise ValueError(f"Request cost {cost:.1f} exceeds the limit of {self.max_cost} "
+                             "(width x height x steps / 512x512)")
+        with self._lock:
+            status, message, retry_after, estimated_wait = self._check(cost)
+            if status is not None:
+                self.rejected[status] += 1
+                raise AdmissionRejected(status, message, retry_after, estimated_wait)
+            if self._items == 0:
+                # Idle time before this request must not count against the drain rate
+                self._mark = time.monotonic()
+            self._in_flight += cost
+            self._items += items
+            self.admitted += 1
+            return estimated_wait
+
+    def release(self, cost, completed=True):
+        """
+        Returns one image's cost to the budget. Completed images also update
+        the drain rate; the time spent on failed or cancelled ones is carried
+        over to the next completion.
+        """
+        with self._lock:
+            if completed:
+                now = time.monotonic()
+                self._busy_seconds = self._busy_seconds * self.decay + (now - self._mark)
+                self._drained_cost = self._drained_cost * self.decay + cost
+                self._mark = now
+            self._in_flight = max(0.0, self._in_flight - cost)
+            self._items -= 1
+
+    def estimate(self, cost=0.0):
+        """What admit(cost) would decide now, without reserving anything."""
+        with self._lock:
+            status, _, retry_after, estimated_wait = self._check(cost)
+        if self.max_cost > 0 and cost > self.max_cost:
+            # Never admitted, however long the client waits
+            retry_after = None
+        elif status is None:
+            retry_after = 0
+        return {
+            "cost": round(cost, 2),
+            "admitted": retry_after == 0,
+            "estimated_wait_seconds": round(estimated_wait, 1),
+            "retry_after_seconds": retry_after,
+        }
+
+    def stats(self):
+        with self._lock:
+            rate = self._rate()
+            return {
+                "in_flight_cost": round(self._in_flight, 2),
+                "in_flight_images": self._items,
+                "max_cost": self.max_cost,
+                "max_wait_seconds": self.max_wait,
+                "drain_rate": round(rate, 3),
+                "estimated_wait_seconds": round(self._in_flight / rate, 1),
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+            }
@@ -1,64 +1,191 @@
-from flask import Flask, request, send_file
+from flask import Flask, Request, Response, g, request, send_file, stream_with_context
 from flask_cors import CORS
-from diffusers import StableDiffusionPipeline
-import torch
 import io
 import os
 import gc
 import json
 import hashlib
-from PIL import Image, ImageDraw, ImageFont, PngImagePlugin
-from stegano import lsb
+from PIL import ImageDraw, ImageFont, PngImagePlugin
+from watermark import lsb_hide, dct_embed
+from verification import (compute_metadata_hash, watermark_payload_for,
+                          verify_image_bytes, InvalidImageError, verify_batch_item, read_png_text,
+                          verify_pool_context)
+from verify_cache import VerificationCache, missing_ledger_hashes
+from scheduler import MicroBatchScheduler, WorkerPool
+from admission import AdmissionController, AdmissionRejected
+from prompt_cache import PromptEmbeddingCache
+from jobs import Job, JobStore, GenerationCancelled
+from similarity import perceptual_hash, open_phash_index
+from backends import MODEL_PROFILE, profile_model_id, load_pipeline, empty_cache
+from ledger import LEDGER_PATH, open_ledger, open_ledger_index
+import metrics
+from metrics import stage_timer
+from storage import ImageStore
+import time
 import uuid
+import zipfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
+class InMemoryRequest(Request):
+    """Keeps uploaded files in memory instead of spooling them to temp files."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
 app = Flask(__name__)
-CORS(app)
+app.request_class = InMemoryRequest
+CORS(app, expose_headers=["X-Image-ID", "ETag", "Retry-After"])
+
+# Uploads are held in memory, so cap their size
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024
 
 # Path configurations
-TEMP_DIR = "temp_files"
 GENERATED_DIR = "generated_images"
-LEDGER_PATH = "image_ledger.json"
+
+# Files are kept in time-bucketed shards: expiry drops whole buckets and
+# a byte quota (0 = unlimited) evicts the oldest buckets as files are written
+STORAGE_BUCKET_SECONDS = int(os.environ.get("STORAGE_BUCKET_SECONDS", 3600))
+STORAGE_RETENTION_HOURS = float(os.environ.get("STORAGE_RETENTION_HOURS", 24))
+GENERATED_QUOTA_MB = int(os.environ.get("GENERATED_QUOTA_MB", 0))
 
 # Ensure directories exist
-os.makedirs(TEMP_DIR, exist_ok=True)
-os.makedirs(GENERATED_DIR, exist_ok=True)
+generated_store = ImageStore(GENERATED_DIR, STORAGE_BUCKET_SECONDS, GENERATED_QUOTA_MB * 1024 * 1024)
+
+# Create the ledger now (importing a legacy image_ledger.json next to it on
+# first start), whether the app is run directly or under a WSGI server
+open_ledger(LEDGER_PATH)
+
+# Generation can be switched off to serve verification only: torch and
+# diffusers are then never imported and no GPU is needed
+GENERATION_ENABLED = os.environ.get("GENERATION_ENABLED", "1").lower() not in ("0", "false", "no")
+
+# Use Stable Diffusion 2.1 model (MODEL_PROFILE=tiny: random weights, see backends.py)
+model_id = profile_model_id(MODEL_PROFILE)
+
+# Set by load_model(); torch is imported lazily together with the model
+torch = None
+model = None
+prompt_cache = None
+model_state = {"status": "loading" if GENERATION_ENABLED else "disabled", "error": None,
+               "device": None, "dtype": None}
 
 # Memory optimization function
 def optimize_memory():
     """Clean up memory resources for better performance"""
     gc.collect()
-    torch.cuda.empty_cache()
-    if torch.cuda.is_available():
-        torch.cuda.ipc_collect()
-
-# Configure for low VRAM usage
-os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "max_split_size_mb:128"
-
-# Load Stable Diffusion model with optimizations for limited VRAM
-print("Loading Stable Diffusion model - this may take a few minutes...")
+    if torch is not None:
+        empty_cache(torch, model_state["device"])
 
-# Use Stable Diffusion 2.1 model
-model_id = "stabilityai/stable-diffusion-2-1"
-
-# Configure pipeline with GPU optimizations
-model = StableDiffusionPipeline.from_pretrained(
-    model_id,
-    torch_dtype=torch.float16,
-    use_safetensors=True,
-    variant="fp16"
-).to("cuda")
+def load_model():
+    """
+    Imports torch and diffusers and loads the configured model profile onto
+    the configured device (GENERATION_DEVICE / GENERATION_DTYPE).
+    """
+    global torch, model, prompt_cache
+    
+    # Configure for low VRAM usage
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "max_split_size_mb:128")
+    
+    import torch as torch_module
+    torch = torch_module
+    
+    print(f"Loading {model_id} - this may take a few minutes...")
+    pipeline, device, dtype = load_pipeline(torch, MODEL_PROFILE)
+    model_state.update(device=device, dtype=str(dtype).replace("torch.", ""))
+    print(f"Model running on {device} ({model_state['dtype']})")
+    
+    # Encode the constant negative prompt once; prompts are cached as they arrive
+    prompt_cache = PromptEmbeddingCache(pipeline, NEGATIVE_PROMPT, max_size=PROMPT_CACHE_SIZE)
+    
+    model = pipeline
+    return model
 
-# Enable memory efficient attention
-model.enable_attention_slicing()
+def start_model_loading():
+    """Loads the model in the background so the server can answer right away."""
+    def run():
+        try:
+            load_model()
+            model_state["status"] = "ready"
+            print(f"{model_id} loaded")
+        except Exception as e:
+            model_state.update(status="failed", error=str(e))
+            print(f"Error loading model: {str(e)}")
+    
+    model_state.update(status="loading", error=None)
+    threading.Thread(target=run, name="model-loader", daemon=True).start()
 
-# Enable VAE slicing for memory efficiency
-model.enable_vae_slicing()
+def generation_unavailable():
+    """Returns an error response while the model cannot serve requests, else None."""
+    status = model_state["status"]
+    if status == "ready":
+        return None
+    if status == "disabled":
+        return {"error": "Image generation is disabled on this server"}, 503
+    if status == "loading":
+        return {"error": "Model is still loading, try again shortly"}, 503, {"Retry-After": "30"}
+    return {"error": f"Model failed to load: {model_state['error']}"}, 503
 
 # Set default image size for 6GB VRAM
 DEFAULT_WIDTH = 512
 DEFAULT_HEIGHT = 512
 
+# Batch generation limits: images per pipeline call and per request
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 4))
+MAX_BATCH_IMAGES = int(os.environ.get("MAX_BATCH_IMAGES", 32))
+
+# Micro-batching: concurrent requests with the same settings share a pipeline call
+SCHEDULER_MAX_BATCH = int(os.environ.get("SCHEDULER_MAX_BATCH", MAX_BATCH_SIZE))
+SCHEDULER_MAX_WAIT_MS = float(os.environ.get("SCHEDULER_MAX_WAIT_MS", 25))
+
+# Post-processing (watermarks, PNG encode, ledger) runs on its own workers so
+# the next inference starts at once; the bounded queue holds raw images and
+# stalls inference when full, which keeps memory bounded
+POSTPROCESS_WORKERS = int(os.environ.get("POSTPROCESS_WORKERS", 2))
+POSTPROCESS_QUEUE = int(os.environ.get("POSTPROCESS_QUEUE", 2 * MAX_BATCH_SIZE))
+
+# Admission control: generations are weighed in 512x512 denoising steps and
+# turned away with 429/503 + Retry-After once the admitted, unfinished work
+# would exceed ADMISSION_MAX_COST or already takes over ADMISSION_MAX_WAIT_SECONDS
+# to drain (0 disables either limit). The default budget fits one full
+# /generate/batch of MAX_BATCH_IMAGES at 50 steps. ADMISSION_DEFAULT_RATE is the assumed
+# drain rate in steps per second until completions have been measured.
+MAX_INFERENCE_STEPS = int(os.environ.get("MAX_INFERENCE_STEPS", 150))
+ADMISSION_MAX_COST = float(os.environ.get("ADMISSION_MAX_COST", MAX_BATCH_IMAGES * 50))
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", 180))
+ADMISSION_DEFAULT_RATE = float(os.environ.get("ADMISSION_DEFAULT_RATE", 4.0))
+
+# Asynchronous jobs: how long finished jobs are kept and the SSE keep-alive interval
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 600))
+SSE_HEARTBEAT_SECONDS = 15
+
+# Batch verification: worker processes and images per request
+VERIFY_WORKERS = int(os.environ.get("VERIFY_WORKERS", os.cpu_count() or 1))
+MAX_VERIFY_BATCH = int(os.environ.get("MAX_VERIFY_BATCH", 1000))
+# Uncompressed size of a /verify/batch zip archive, checked before anything is extracted
+MAX_VERIFY_ARCHIVE_MB = int(os.environ.get("MAX_VERIFY_ARCHIVE_MB", 1024))
+
+# Verification results cached by upload content hash (0 entries disables the cache)
+VERIFY_CACHE_SIZE = int(os.environ.get("VERIFY_CACHE_SIZE", 4096))
+VERIFY_CACHE_TTL_SECONDS = int(os.environ.get("VERIFY_CACHE_TTL_SECONDS", 3600))
+
+# zlib level for secured PNGs: lower is faster to encode, higher is smaller
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", 6))
+
+# Background writer for generated images, so responses never wait on disk.
+# Queued images are held in memory until written; when the queue is full,
+# post-processing waits for the disk and in turn stalls inference
+DISK_WRITE_QUEUE = int(os.environ.get("DISK_WRITE_QUEUE", 2 * MAX_BATCH_SIZE))
+disk_writer = WorkerPool(num_workers=2, max_queue=DISK_WRITE_QUEUE, name="disk-writer")
+
+# Number of encoded prompts kept by the prompt embedding cache
+PROMPT_CACHE_SIZE = int(os.environ.get("PROMPT_CACHE_SIZE", 256))
+
+# Qualities steered away from on every generation
+NEGATIVE_PROMPT = "cartoon, anime, illustration, painting, drawing, art, sketch, low quality, worst quality, blurry, grainy, noisy, watermark, signature, text, deformed, distorted, disfigured, bad anatomy, unrealistic"
+
 # ---------- 1. Image Enhancement Functions ----------
 
 def enhance_prompt(prompt):
@@ -91,97 +218,60 @@ def enhance_prompt(prompt):
 
 # ---------- 2. STEGANOGRAPHIC WATERMARKING ----------
 
-def embed_steganographic_watermark(image, watermark_text):
+def embed_steganographic_watermark(image, watermark):
     """
-    Hides a given text message (watermark_text) in the image
-    using least significant bit (LSB) steganography.
+    Hides a watermark in the image using least significant bit (LSB)
+    steganography: a packed binary payload (bytes) or a text message.
+    The bits are written directly into the image's pixel buffer.
     """
-    # Save image temporarily to use with stegano
-    temp_path = os.path.join(TEMP_DIR, f"temp_{uuid.uuid4()}.png")
-    image.save(temp_path)
-    
-    try:
-        # Apply steganographic watermark
-        secret_image = lsb.hide(temp_path, watermark_text)
-        return secret_image
-    finally:
-        # Always remove temp file
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+    return lsb_hide(image, watermark)
 
-def extract_watermark(image_path):
-    """Extracts the hidden watermark from the image."""
-    try:
-        return lsb.reveal(image_path)
-    except Exception as e:
-        # Handle extraction errors gracefully
-        print(f"Watermark extraction error: {str(e)}")
-        return None
+def embed_frequency_watermark(image):
+    """
+    Adds a keyed spread-spectrum watermark to the block-DCT coefficients of
+    the luminance. Unlike the LSB watermark it survives JPEG re-encoding.
+    """
+    return dct_embed(image)
 
 # ---------- 3. METADATA HASHING ----------
 
-def compute_metadata_hash(metadata_dict):
-    """
-    Converts metadata dict to sorted JSON, hashes it with SHA-256.
-    This ensures even tiny changes to metadata will result in a different hash.
-    """
-    metadata_json = json.dumps(metadata_dict, sort_keys=True)
-    return hashlib.sha256(metadata_json.encode()).hexdigest()
+# compute_metadata_hash is shared with the verifier, see verification.py
 
 # ---------- 4. SIMULATED BLOCKCHAIN LEDGER ----------
 
-def save_hash_to_ledger(image_hash, ledger_path=LEDGER_PATH):
+def save_hash_to_ledger(image_hash, ledger_path=LEDGER_PATH, content_digest=None):
     """
-    Appends the image hash to a local JSON ledger. Simulates immutability
-    by logging only the hash for future comparison.
+    Appends the image hash to the ledger store. Simulates immutability
+    by logging only the hash for future comparison. content_digest, the
+    SHA-256 of the secured PNG bytes, lets the verifier recognise an
+    unmodified image from its metadata alone.
     """
-    # Create a lock mechanism to prevent race conditions
-    lock_file = f"{ledger_path}.lock"
-    
-    # Simple file-based locking
-    retry_count = 0
-    while os.path.exists(lock_file) and retry_count < 5:
-        # Wait and retry
-        import time
-        time.sleep(0.5)
-        retry_count += 1
-    
+    record = {
+        "timestamp": datetime.now().isoformat(),
+        "status": "Verified"
+    }
+    if content_digest:
+        record["content_sha256"] = content_digest
     try:
-        # Create lock file
-        with open(lock_file, 'w') as f:
-            f.write('locked')
-        
-        if os.path.exists(ledger_path):
-            with open(ledger_path, "r") as f:
-                try:
-                    ledger = json.load(f)
-                except json.JSONDecodeError:
-                    # Handle corrupted ledger
-                    ledger = {}
-        else:
-            ledger = {}
-
-        ledger[image_hash] = {
-            "timestamp": datetime.now().isoformat(),
-            "status": "Verified"
-        }
-
-        with open(ledger_path, "w") as f:
-            json.dump(ledger, f, indent=4)
-        
-        return True
+        return open_ledger(ledger_path).append(image_hash, record)
     except Exception as e:
         print(f"Error saving to ledger: {str(e)}")
         return False
-    finally:
-        # Always remove lock file
-        if os.path.exists(lock_file):
-            os.remove(lock_file)
+
+def save_perceptual_hash(image, image_hash, image_id):
+    """Adds the image's perceptual hash to the similarity index."""
+    try:
+        open_phash_index().add(perceptual_hash(image), image_hash, image_id)
+    except Exception as e:
+        print(f"Error saving perceptual hash: {str(e)}")
 
 # ---------- 5. METADATA EMBEDDING ----------
 
 def embed_metadata(image, metadata):
-    """Embeds metadata into the image and returns the image with its hash."""
+    """
+    Embeds metadata into the image's PNG encoding.
+    This is the only PNG encode of a secured image; returns (png_bytes, hash).
+    """
     # Compute hash before embedding
     metadata_hash = compute_metadata_hash(metadata)
     
@@ -201,28 +291,20 @@ def embed_metadata(image, metadata):
     
     # Save image with metadata to a bytes buffer
     buffer = io.BytesIO()
-    image.save(buffer, format='PNG', pnginfo=png_info, optimize=False)
-    buffer.seek(0)
-    
-    # Create a new image from the buffer to ensure metadata is loaded
-    final_image = Image.open(buffer)
-    
-    # Store the PngInfo object with the image for later use
-    final_image.custom_pnginfo = png_info
+    image.save(buffer, format='PNG', pnginfo=png_info, optimize=False, compress_level=PNG_COMPRESS_LEVEL)
     
-    # Return the final image with metadata
-    return final_image, metadata_hash
+    return buffer.getvalue(), metadata_hash
 
 # ---------- 6. FULL SECURITY PIPELINE ----------
 
 def secure_image_pipeline(image, prompt):
     """
     Applies the full security process to an image:
-    1. Embeds steganographic watermark
+    1. Embeds frequency-domain and steganographic watermarks
     2. Adds metadata with a hash
     3. Logs the hash in a blockchain-like ledger
     
-    Returns the fully secured image.
+    Returns the final PNG bytes and the embedded metadata.
     """
     # Step 1: Create a unique ID for this image
     image_id = str(uuid.uuid4())
@@ -235,21 +317,190 @@ def secure_image_pipeline(image, prompt):
         "GeneratedBy": model_id  # Use the actual model_id variable
     }
     
-    # Step 3: Create steganographic watermark (hidden)
-    watermark_text = f"{model_id} {image_id} - {metadata['GenerationDate']}"
-    steg_image = embed_steganographic_watermark(image, watermark_text)
+    # Step 3: Add the frequency-domain watermark, then the steganographic one
+    # on top (the LSB layer must be the last change to the pixels)
+    watermark = watermark_payload_for(metadata)
+    with stage_timer("secure", "frequency_watermark"):
+        freq_image = embed_frequency_watermark(image)
+    with stage_timer("secure", "lsb_watermark"):
+        steg_image = embed_steganographic_watermark(freq_image, watermark)
     
     # Step 4: Embed metadata and get hash
-    secured_image, image_hash = embed_metadata(steg_image, metadata)
+    with stage_timer("secure", "png_encode"):
+        png_bytes, image_hash = embed_metadata(steg_image, metadata)
     
-    # Step 5: Save hash to blockchain ledger
-    save_hash_to_ledger(image_hash)
+    # Step 5: Save hash to blockchain ledger, with a perceptual hash so copies
+    # that lost their metadata can still be traced back to this record
+    with stage_timer("secure", "ledger_append"):
+        save_hash_to_ledger(image_hash, content_digest=hashlib.sha256(png_bytes).hexdigest())
+    with stage_timer("secure", "perceptual_hash"):
+        save_perceptual_hash(steg_image, image_hash, image_id)
     
     # Step 6: Return final image
-    return secured_image
+    return png_bytes, metadata
+
+def generate_batch(prompts, width, height, num_inference_steps, guidance_scale, step_callback=None):
+    """
+    Runs the model over a list of prompts (one entry per wanted image),
+    MAX_BATCH_SIZE images per pipeline call. Returns images in prompt order.
+    step_callback(step) is called after every denoising step.
+    """
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        step_callback(step + 1)
+        return callback_kwargs
+    
+    images = []
+    for start in range(0, len(prompts), MAX_BATCH_SIZE):
+        chunk = prompts[start:start + MAX_BATCH_SIZE]
+        
+        # Identical prompts are encoded once and expanded by the pipeline
+        if len(set(chunk)) == 1:
+            batch_prompts, images_per_prompt = chunk[:1], len(chunk)
+        else:
+            batch_prompts, images_per_prompt = chunk, 1
+        
+        # Text-encoder outputs come from the cache instead of being recomputed
+        with stage_timer("generate", "prompt_encode"):
+            prompt_embeds, negative_prompt_embeds = prompt_cache.batch([enhance_prompt(p) for p in batch_prompts])
+        
+        with stage_timer("generate", "inference"):
+            images.extend(model(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                num_images_per_prompt=images_per_prompt,
+                width=width,
+                height=height,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                callback_on_step_end=on_step_end if step_callback else None
+            ).images)
+    return images
+
+def run_scheduled_batch(key, items):
+    """
+    Runs one micro-batch of queued (prompt, job) items that share the same
+    settings. Jobs get per-step progress, and a batch made only of
+    cancelled jobs is stopped at the next step.
+    """
+    width, height, num_inference_steps, guidance_scale = key
+    prompts = [prompt for prompt, _ in items]
+    jobs = [job for _, job in items if job is not None]
+    
+    def step_callback(step):
+        for job in jobs:
+            job.set_progress(step)
+        if len(jobs) == len(items) and all(job.cancelled for job in jobs):
+            raise GenerationCancelled()
+    
+    # Run memory optimization before generation
+    with stage_timer("generate", "optimize_memory"):
+        optimize_memory()
+    return generate_batch(prompts, width, height, num_inference_steps, guidance_scale,
+                          step_callback if jobs else None)
+
+def postprocess_image(item, image):
+    """
+    Secures and stores one generated image on a post-processing worker.
+    Returns (png_bytes, metadata) to whoever is waiting for the image.
+    """
+    prompt, job = item
+    if job is not None and job.cancelled:
+        raise GenerationCancelled()
+    with stage_timer("secure", "total"):
+        png_bytes, metadata = secure_image_pipeline(image, prompt)
+    save_generated_image(png_bytes, metadata["ImageID"])
+    return png_bytes, metadata
+
+postprocess_pool = WorkerPool(
+    num_workers=POSTPROCESS_WORKERS,
+    max_queue=POSTPROCESS_QUEUE,
+    name="postprocess"
+)
+
+generation_scheduler = MicroBatchScheduler(
+    run_scheduled_batch,
+    max_batch_size=SCHEDULER_MAX_BATCH,
+    max_wait=SCHEDULER_MAX_WAIT_MS / 1000,
+    name="generation-scheduler",
+    postprocess=postprocess_image,
+    pool=postprocess_pool
+)
+
+admission = AdmissionController(
+    max_cost=ADMISSION_MAX_COST,
+    max_wait=ADMISSION_MAX_WAIT_SECONDS,
+    default_rate=ADMISSION_DEFAULT_RATE
+)
+
+def schedule_generation(prompts, width, height, num_inference_steps, guidance_scale, job=None):
+    """
+    Admits and queues one image per prompt. Returns futures of their
+    (png_bytes, metadata) and the estimated seconds until they are done.
+    Raises AdmissionRejected when the server is too busy to take them.
+    """
+    image_cost = admission.cost(width, height, num_inference_steps)
+    estimated_wait = admission.admit(image_cost * len(prompts), items=len(prompts))
+    
+    def release(future):
+        admission.release(image_cost, completed=not future.cancelled() and future.exception() is None)
+    
+    key = (width, height, num_inference_steps, guidance_scale)
+    futures = [generation_scheduler.submit(key, (prompt, job)) for prompt in prompts]
+    for future in futures:
+        future.add_done_callback(release)
+    return futures, estimated_wait
+
+def admission_rejected(e):
+    """The 429/503 response for a rejected generation."""
+    return {
+        "error": f"{e.message} (retry in {e.retry_after}s)",
+        "retry_after_seconds": e.retry_after,
+        "estimated_wait_seconds": round(e.estimated_wait, 1)
+    }, e.status, {"Retry-After": str(e.retry_after)}
+
+def parse_generation_settings(data):
+    """
+    Reads width, height, steps and guidance_scale from a request body.
+    Raises ValueError for malformed values.
+    """
+    width = int(data.get('width', DEFAULT_WIDTH))
+    height = int(data.get('height', DEFAULT_HEIGHT))
+    num_inference_steps = int(data.get('steps', 50))
+    guidance_scale = float(data.get('guidance_scale', 12.0))
+    if width < 1 or height < 1:
+        raise ValueError("width and height must be positive")
+    if not 1 <= num_inference_steps <= MAX_INFERENCE_STEPS:
+        raise ValueError(f"steps must be between 1 and {MAX_INFERENCE_STEPS}")
+    return width, height, num_inference_steps, guidance_scale
+
+# Images queued for writing, served from memory until they are on disk
+pending_images = {}
+
+def save_generated_image(png_bytes, image_id):
+    """
+    Queues secured PNG bytes to be stored under image_id in the content-addressed
+    GENERATED_DIR store; the write happens in the background, but queueing
+    blocks while DISK_WRITE_QUEUE images are already waiting.
+    """
+    pending_images[image_id] = png_bytes
+    disk_writer.submit(write_file, generated_store, image_id, png_bytes)
+    return image_id
+
+def write_file(store, image_id, data):
+    try:
+        with stage_timer("storage", "disk_write"):
+            store.put(image_id, data)
+    except Exception as e:
+        print(f"Error saving {image_id} to {store.root}: {str(e)}")
+    finally:
+        pending_images.pop(image_id, None)
 
 @app.route('/generate', methods=['POST'])
 def generate_image():
+    unavailable = generation_unavailable()
+    if unavailable:
+        return unavailable
+    
     # Get parameters from request
     try:
         data = request.json
@@ -257,58 +508,100 @@ def generate_image():
             return {"error": "Invalid JSON data"}, 400
             
         prompt = data.get('prompt')
-        width = int(data.get('width', DEFAULT_WIDTH))
-        height = int(data.get('height', DEFAULT_HEIGHT))
-        num_inference_steps = int(data.get('steps', 50))
-        guidance_scale = float(data.get('guidance_scale', 12.0))
+        width, height, num_inference_steps, guidance_scale = parse_generation_settings(data)
         
         # Validate prompt
         if not prompt:
             return {"error": "No prompt provided"}, 400
         
-        # Enhance prompt automatically
-        enhanced_prompt = enhance_prompt(prompt)
-        
         # Validate dimensions for VRAM constraints
         if width * height > 512 * 512:
             return {"error": "Image dimensions too large for available VRAM. Max recommended is 512x512"}, 400
         
-        # Run memory optimization before generation
-        optimize_memory()
+        # Generate image; the scheduler batches it with matching concurrent requests,
+        # then a post-processing worker secures it and saves it under its ImageID
+        with stage_timer("generate", "scheduled"):
+            futures, _ = schedule_generation([prompt], width, height, num_inference_steps, guidance_scale)
+            png_bytes, metadata = futures[0].result()
+        
+        # Free up memory
+        with stage_timer("generate", "optimize_memory"):
+            optimize_memory()
         
-        # Generate image with optimized parameters
-        image = model(
-            prompt=enhanced_prompt,
-            negative_prompt="cartoon, anime, illustration, painting, drawing, art, sketch, low quality, worst quality, blurry, grainy, noisy, watermark, signature, text, deformed, distorted, disfigured, bad anatomy, unrealistic",
-            width=width,
-            height=height,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale
-        ).images[0]
+        # Return the same bytes that were written to disk
+        response = send_file(io.BytesIO(png_bytes), mimetype="image/png")
+        response.headers["X-Image-ID"] = metadata["ImageID"]
+        return response
+    except AdmissionRejected as e:
+        return admission_rejected(e)
+    except ValueError as ve:
+        return {"error": f"Invalid parameter: {str(ve)}"}, 400
+    except Exception as e:
+        # Handle errors gracefully
+        optimize_memory()  # Clean up memory in case of error
+        return {"error": str(e)}, 500
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_image_batch():
+    """
+    Generates several images in batched pipeline calls.
+    Accepts either {"prompts": [...]} or {"prompt": "...", "count": n}
+    (count also applies per prompt when combined with "prompts").
+    Returns a zip with one PNG per image and a manifest.json of ledger entries.
+    """
+    unavailable = generation_unavailable()
+    if unavailable:
+        return unavailable
+    
+    try:
+        data = request.json
+        if not data:
+            return {"error": "Invalid JSON data"}, 400
         
-        # Apply the full security pipeline to the generated image
-        secured_image = secure_image_pipeline(image, prompt)
+        prompts = data.get('prompts')
+        if prompts is None:
+            prompts = [data.get('prompt')]
+        count = int(data.get('count', 1))
+        width, height, num_inference_steps, guidance_scale = parse_generation_settings(data)
         
-        # Generate unique filename
-        filename = f"generated_{uuid.uuid4()}.png"
-        save_path = os.path.join(GENERATED_DIR, filename)
+        # Validate prompts
+        if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) and p for p in prompts):
+            return {"error": "No prompt provided"}, 400
+        if count < 1 or len(prompts) * count > MAX_BATCH_IMAGES:
+            return {"error": f"A batch must contain between 1 and {MAX_BATCH_IMAGES} images"}, 400
         
-        # Save the secured image to disk with a unique filename
-        secured_image.save(save_path, format="PNG")
+        # Validate dimensions for VRAM constraints
+        if width * height > 512 * 512:
+            return {"error": "Image dimensions too large for available VRAM. Max recommended is 512x512"}, 400
+        
+        image_prompts = [p for p in prompts for _ in range(count)]
+        # Every image is secured and saved by the post-processing workers
+        futures, _ = schedule_generation(image_prompts, width, height, num_inference_steps, guidance_scale)
+        secured = [future.result() for future in futures]
+        
+        buffer = io.BytesIO()
+        manifest = []
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+            for index, (prompt, (png_bytes, metadata)) in enumerate(zip(image_prompts, secured)):
+                archive_name = f"image_{index:03d}.png"
+                archive.writestr(archive_name, png_bytes)
+                manifest.append({
+                    "file": archive_name,
+                    "prompt": prompt,
+                    "ImageID": metadata["ImageID"],
+                    "image_url": f"/images/{metadata['ImageID']}",
+                    "GenerationDate": metadata["GenerationDate"],
+                    "TamperCheckHash": metadata["TamperCheckHash"]
+                })
+            archive.writestr("manifest.json", json.dumps(manifest, indent=4))
         
         # Free up memory
         optimize_memory()
         
-        # Return image
-        buffer = io.BytesIO()
-        # Use the stored PngInfo when saving for return
-        if hasattr(secured_image, 'custom_pnginfo'):
-            secured_image.save(buffer, format="PNG", pnginfo=secured_image.custom_pnginfo)
-        else:
-            secured_image.save(buffer, format="PNG")
         buffer.seek(0)
-        
-        return send_file(buffer, mimetype="image/png")
+        return send_file(buffer, mimetype="application/zip", as_attachment=True, download_name="images.zip")
+    except AdmissionRejected as e:
+        return admission_rejected(e)
     except ValueError as ve:
         return {"error": f"Invalid parameter: {str(ve)}"}, 400
     except Exception as e:
@@ -316,6 +609,208 @@ def generate_image():
         optimize_memory()  # Clean up memory in case of error
         return {"error": str(e)}, 500
 
+@app.route('/generate/stats', methods=['GET'])
+def generation_stats():
+    """Reports queue depths, batch-size distribution, admission state and prompt cache hits."""
+    return {
+        "scheduler": generation_scheduler.stats(),
+        "postprocess": postprocess_pool.stats(),
+        "disk_writer": disk_writer.stats(),
+        "admission": admission.stats(),
+        "prompt_cache": prompt_cache.stats() if prompt_cache else None
+    }
+
+@app.route('/generate/estimate', methods=['GET'])
+def generation_estimate():
+    """
+    Estimated wait for a generation with the given width, height, steps and
+    count query parameters, and whether it would be admitted right now.
+    """
+    try:
+        width, height, num_inference_steps, _ = parse_generation_settings(request.args)
+        count = int(request.args.get('count', 1))
+    except ValueError as ve:
+        return {"error": f"Invalid parameter: {str(ve)}"}, 400
+    return admission.estimate(admission.cost(width, height, num_inference_steps, count))
+
+# ---------- ASYNCHRONOUS GENERATION JOBS ----------
+
+generation_jobs = JobStore(ttl=JOB_TTL_SECONDS)
+
+def finish_job(job, future):
+    """Records the outcome of a job once its image has been secured and stored."""
+    if future.cancelled() or job.cancelled:
+        job.cancel()
+        return
+    try:
+        png_bytes, metadata = future.result()
+        job.succeed(png_bytes, metadata["ImageID"])
+    except GenerationCancelled:
+        job.cancel()
+    except Exception as e:
+        print(f"Job {job.id} failed: {str(e)}")
+        job.fail(str(e))
+
+def get_job_or_404(job_id):
+    job = generation_jobs.get(job_id)
+    if job is None:
+        return None, ({"error": "Unknown job id"}, 404)
+    return job, None
+
+@app.route('/jobs', methods=['POST'])
+def create_generation_job():
+    """Queues a generation and returns its job id immediately."""
+    unavailable = generation_unavailable()
+    if unavailable:
+        return unavailable
+    
+    try:
+        data = request.json
+        if not data:
+            return {"error": "Invalid JSON data"}, 400
+        
+        prompt = data.get('prompt')
+        if not prompt:
+            return {"error": "No prompt provided"}, 400
+        width, height, num_inference_steps, guidance_scale = parse_generation_settings(data)
+    except ValueError as ve:
+        return {"error": f"Invalid parameter: {str(ve)}"}, 400
+    
+    # Validate dimensions for VRAM constraints
+    if width * height > 512 * 512:
+        return {"error": "Image dimensions too large for available VRAM. Max recommended is 512x512"}, 400
+    
+    job = Job(prompt, num_inference_steps)
+    try:
+        futures, estimated_wait = schedule_generation([prompt], width, height, num_inference_steps,
+                                                      guidance_scale, job=job)
+    except AdmissionRejected as e:
+        return admission_rejected(e)
+    except ValueError as ve:
+        return {"error": f"Invalid parameter: {str(ve)}"}, 400
+    generation_jobs.add(job)
+    job.future = futures[0]
+    if job.cancelled:
+        job.future.cancel()
+    job.future.add_done_callback(lambda future: finish_job(job, future))
+    
+    return {
+        **job.to_dict(),
+        "estimated_wait_seconds": round(estimated_wait, 1),
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events",
+        "result_url": f"/jobs/{job.id}/result"
+    }, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_generation_job(job_id):
+    job, error = get_job_or_404(job_id)
+    if error:
+        return error
+    return job.to_dict()
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_generation_job(job_id):
+    """Cancels a job; queued jobs never reach the model."""
+    job, error = get_job_or_404(job_id)
+    if error:
+        return error
+    if not job.cancel() and not job.cancelled:
+        return {"error": f"Job already {job.status}"}, 409
+    return job.to_dict()
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_generation_job(job_id):
+    """Server-Sent Events stream of job progress, ending with a 'done' event."""
+    job, error = get_job_or_404(job_id)
+    if error:
+        return error
+    
+    def events():
+        version = None
+        while True:
+            if job.version != version:
+                version = job.version
+                event = "done" if job.finished else "progress"
+                yield f"event: {event}\ndata: {json.dumps(job.to_dict())}\n\n"
+                if job.finished:
+                    return
+            elif job.wait_for_change(version, SSE_HEARTBEAT_SECONDS) == version:
+                yield ": keep-alive\n\n"
+    
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_generation_job_result(job_id):
+    """Returns the secured PNG of a finished job."""
+    job, error = get_job_or_404(job_id)
+    if error:
+        return error
+    if job.status != "succeeded":
+        return {**job.to_dict(), "error": job.error or f"Job is {job.status}"}, 409
+    response = send_file(io.BytesIO(job.result), mimetype="image/png")
+    response.headers["X-Image-ID"] = job.image_id
+    return response
+
+# ---------- IMAGE RETRIEVAL ----------
+
+# Cache lifetime of /images responses; an ImageID always names the same bytes
+IMAGE_CACHE_SECONDS = int(os.environ.get("IMAGE_CACHE_SECONDS", 365 * 24 * 3600))
+
+@app.route('/images/<image_id>', methods=['GET'])
+def get_image(image_id):
+    """
+    Returns a stored generated image by its ImageID, streamed from disk.
+    The ETag is the SHA-256 of the PNG bytes, so If-None-Match and Range
+    requests work and shared caches can keep the response indefinitely.
+    """
+    png_bytes = pending_images.get(image_id)
+    if png_bytes is not None:
+        digest = hashlib.sha256(png_bytes).hexdigest()
+        source = io.BytesIO(png_bytes)
+    else:
+        stored = generated_store.locate(image_id)
+        if stored is None:
+            return {"error": "Unknown or expired image id"}, 404
+        source, digest, _ = stored
+    
+    response = send_file(source, mimetype="image/png", conditional=True, etag=digest,
+                         max_age=IMAGE_CACHE_SECONDS, download_name=f"{image_id}.png")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.headers["X-Image-ID"] = image_id
+    return response
+
+# ---------- VERIFICATION RESULT CACHE ----------
+
+verify_cache = VerificationCache(max_size=VERIFY_CACHE_SIZE, ttl=VERIFY_CACHE_TTL_SECONDS)
+
+def is_recorded(image_hash):
+    return image_hash in open_ledger_index(LEDGER_PATH)
+
+def cache_verification(key, data, result):
+    """Caches a fresh result together with the ledger hashes it found missing."""
+    stored_hash = (read_png_text(data) or {}).get("TamperCheckHash")
+    verify_cache.put(key, result, missing_ledger_hashes(result, stored_hash))
+
+def verify_cached(data):
+    """verify_image_bytes, answered from the cache for bytes seen before."""
+    key = verify_cache.key(data)
+    result = verify_cache.get(key, is_recorded)
+    if result is None:
+        result = verify_image_bytes(data)
+        cache_verification(key, data, result)
+    return result
+
+@app.route('/verify/stats', methods=['GET'])
+def verification_stats():
+    """Reports verification cache size and hit ratio, and ledger index lookups."""
+    return {
+        "cache": verify_cache.stats(),
+        "ledger_index": open_ledger_index(LEDGER_PATH).stats()
+    }
+
 @app.route('/verify', methods=['POST'])
 def verify_image():
     """
@@ -324,145 +819,312 @@ def verify_image():
     if 'image' not in request.files:
         return {"error": "No image file uploaded"}, 400
     
-    temp_path = None
     try:
         file = request.files['image']
         
-        # Make sure the temp directory exists
-        os.makedirs(TEMP_DIR, exist_ok=True)
-        
-        # Get file extension and create a proper temp file with that extension
-        filename = file.filename
-        file_ext = os.path.splitext(filename)[1].lower() if filename else '.png'
-        
-        # Save the uploaded file with a unique name and proper extension
-        temp_path = os.path.join(TEMP_DIR, f"temp_verify_{uuid.uuid4()}{file_ext}")
-        file.save(temp_path)
-        
-        # Try to open the image to verify it's a valid image file
+        # Unmodified PNGs are verified from their text chunks; anything else
+        # is decoded once, straight from memory; nothing touches the disk
         try:
-            image = Image.open(temp_path)
-            # Convert to PNG if it's not already for consistent processing
-            if file_ext != '.png':
-                png_temp_path = temp_path.replace(file_ext, '.png')
-                image.save(png_temp_path, format="PNG")
-                # Remove the original temp file
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                temp_path = png_temp_path
-        except Exception as e:
-            return {"error": f"Invalid image file: {str(e)}"}, 400
-        
-        # Extract watermark
-        try:
-            watermark = extract_watermark(temp_path)
-            watermark_found = watermark is not None
-        except Exception as e:
-            watermark = None
-            watermark_found = False
-            print(f"Watermark extraction error: {str(e)}")
-        
-        # Extract and check metadata
-        image = Image.open(temp_path)
-        
-        # Get metadata from image info or png text chunks
-        metadata = {}
-        if hasattr(image, 'text'):
-            metadata.update(image.text)
-        if hasattr(image, 'info'):
-            metadata.update(image.info)
-        
-        # Remove hash for computing new hash
-        stored_hash = metadata.get("TamperCheckHash")
-        hash_found = stored_hash is not None
-        
-        if hash_found:
-            # Verify hash
-            temp_metadata = {k: v for k, v in metadata.items() if k != "TamperCheckHash"}
-            recomputed_hash = compute_metadata_hash(temp_metadata)
-            hash_valid = stored_hash == recomputed_hash
-            
-            # Check in ledger
-            if os.path.exists(LEDGER_PATH):
-                with open(LEDGER_PATH, "r") as f:
-                    try:
-                        ledger = json.load(f)
-                        on_blockchain = stored_hash in ledger
-                    except json.JSONDecodeError:
-                        on_blockchain = False
-            else:
-                on_blockchain = False
-        else:
-            hash_valid = False
-            on_blockchain = False
-        
-        # Determine if this is an AI-generated image
-        # Only consider it AI-generated if it has EITHER a watermark OR valid metadata
-        is_ai_generated = watermark_found or hash_found
-        
-        # Create a clear message for the user
-        if is_ai_generated:
-            image_type = "AI-generated image"
-            confidence = 100 if (watermark_found and hash_valid and on_blockchain) else 85
-            if watermark_found and hash_valid and on_blockchain:
-                authenticity = "Verified authentic AI-generated image"
-            else:
-                authenticity = "AI-generated image with potential tampering"
-        else:
-            image_type = "Not an AI-generated image"
-            authenticity = "This appears to be a regular image, not generated by this system"
-            confidence = 0  # 0% confidence it's AI-generated
-        
-        return {
-            "verification": {
-                "image_type": image_type,
-                "authenticity": authenticity,
-                "confidence": confidence,
-                "watermark_found": watermark_found,
-                "watermark_content": watermark if watermark_found else None,
-                "metadata_hash_found": hash_found,
-                "metadata_valid": hash_valid,
-                "on_blockchain": on_blockchain,
-                "is_authentic": watermark_found and hash_valid and on_blockchain,
-                "is_ai_generated": is_ai_generated,
-                "metadata": {k: v for k, v in metadata.items() if k != "TamperCheckHash"}
-            }
-        }
+            return {"verification": verify_cached(file.read())}
+        except InvalidImageError as e:
+            return {"error": str(e)}, 400
     except Exception as e:
         # Provide a more detailed error message
         import traceback
         error_details = traceback.format_exc()
         print(f"Verification error: {error_details}")
         return {"error": f"Error verifying image: {str(e)}"}, 500
-    finally:
-        # Clean up temp file
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
 
-# Helper function to clean old temporary files
-def cleanup_temp_files(max_age_hours=24):
-    """Remove temporary files older than max_age_hours"""
-    current_time = datetime.now()
+# ---------- LEDGER PROOFS ----------
+
+@app.route('/ledger/roots', methods=['GET'])
+def ledger_roots():
+    """
+    The chained Merkle batch roots, oldest first (?since=<batch_id> for only
+    newer ones). Together with an inclusion proof they let a verifier check
+    a ledger entry without the ledger.
+    """
+    ledger = open_ledger(LEDGER_PATH)
+    if not hasattr(ledger, "roots"):
+        return {"error": "This ledger backend does not seal batches"}, 404
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError as ve:
+        return {"error": f"Invalid parameter: {str(ve)}"}, 400
+    return {"roots": ledger.roots(since)}
+
+@app.route('/ledger/proof/<image_hash>', methods=['GET'])
+def ledger_proof(image_hash):
+    """O(log n) inclusion proof of a TamperCheckHash in its batch root."""
+    ledger = open_ledger(LEDGER_PATH)
+    proof = ledger.proof(image_hash) if hasattr(ledger, "proof") else None
+    if proof is None:
+        return {"error": "Hash not found in a sealed ledger batch"}, 404
+    return proof
+
+# ---------- HEALTH AND READINESS ----------
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Liveness: the process is up and serving requests."""
+    return {"status": "ok"}
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness: verification is always ready; generation only once the
+    model has loaded. Verify-only servers are ready immediately.
+    """
+    status = model_state["status"]
+    body = {
+        "ready": status in ("ready", "disabled"),
+        "generation": status,
+        "verification": "ready",
+        "device": model_state["device"],
+        "dtype": model_state["dtype"]
+    }
+    if model_state["error"]:
+        body["error"] = model_state["error"]
+    return body, 200 if body["ready"] else 503
+
+# ---------- METRICS ----------
+
+REQUEST_SECONDS = metrics.register(metrics.Histogram(
+    "markai_request_duration_seconds",
+    "Time to serve a request, including streamed bodies.",
+    labelnames=("method", "endpoint")
+))
+requests_in_flight = metrics.InFlight()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    requests_in_flight.inc()
+
+@app.teardown_request
+def stop_request_timer(exc):
+    started = g.pop("request_started", None)
+    if started is None:
+        return
+    requests_in_flight.dec()
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_SECONDS.observe(time.perf_counter() - started, request.method, endpoint)
+
+@metrics.gauge("markai_requests_in_flight", "Requests currently being served.")
+def read_requests_in_flight():
+    return requests_in_flight.value
+
+@metrics.gauge("markai_model_ready", "1 when the generation model is loaded.")
+def read_model_ready():
+    return int(model_state["status"] == "ready")
+
+@metrics.gauge("markai_ledger_entries", "Image hashes recorded in the ledger.")
+def read_ledger_entries():
+    # The index only pulls what was appended since the last scrape, so the
+    # cost does not grow with the ledger (a COUNT(*) would)
+    index = open_ledger_index(LEDGER_PATH)
+    index.refresh()
+    return len(index)
+
+@metrics.gauge("markai_storage_bytes", "Bytes used by stored files.", labelnames=("directory",))
+def read_storage_bytes():
+    return {store.root: store.usage()["bytes"] for store in (generated_store,)}
+
+@metrics.gauge("markai_storage_files", "Number of stored files.", labelnames=("directory",))
+def read_storage_files():
+    return {store.root: store.usage()["files"] for store in (generated_store,)}
+
+@metrics.gauge("markai_storage_evicted_bytes_total", "Bytes evicted to stay within the storage quota.",
+               labelnames=("directory",), kind="counter")
+def read_storage_evicted_bytes():
+    return {store.root: store.usage()["evicted_bytes"] for store in (generated_store,)}
+
+@metrics.gauge("markai_pipeline_queue_depth", "Work waiting for each generation pipeline stage.",
+               labelnames=("stage",))
+def read_pipeline_queue_depth():
+    return {"inference": generation_scheduler.queue_depth(), "postprocess": postprocess_pool.queue_depth(),
+            "disk_write": disk_writer.queue_depth()}
+
+@metrics.gauge("markai_pipeline_in_progress", "Images being processed by each generation pipeline stage.",
+               labelnames=("stage",))
+def read_pipeline_in_progress():
+    return {"inference": generation_scheduler.stats()["in_progress"],
+            "postprocess": postprocess_pool.stats()["in_progress"],
+            "disk_write": disk_writer.stats()["in_progress"]}
+
+@metrics.gauge("markai_admission_in_flight_cost", "Admitted, unfinished generation work in 512x512 steps.")
+def read_admission_in_flight_cost():
+    return admission.stats()["in_flight_cost"]
+
+@metrics.gauge("markai_admission_drain_rate", "Measured generation throughput in 512x512 steps per second.")
+def read_admission_drain_rate():
+    return admission.stats()["drain_rate"]
+
+@metrics.gauge("markai_admission_estimated_wait_seconds", "Estimated time to drain the admitted generation work.")
+def read_admission_estimated_wait():
+    return admission.stats()["estimated_wait_seconds"]
+
+@metrics.gauge("markai_admission_rejected_total", "Generation requests turned away by admission control.",
+               labelnames=("status",), kind="counter")
+def read_admission_rejected():
+    return admission.stats()["rejected"]
+
+@metrics.gauge("markai_scheduler_batches_total", "Pipeline batches run by the scheduler.", kind="counter")
+def read_scheduler_batches():
+    return generation_scheduler.stats()["batches"]
+
+@metrics.gauge("markai_scheduler_items_total", "Images generated through the scheduler.", kind="counter")
+def read_scheduler_items():
+    return generation_scheduler.stats()["items"]
+
+@metrics.gauge("markai_prompt_cache_lookups_total", "Prompt embedding cache lookups.",
+               labelnames=("result",), kind="counter")
+def read_prompt_cache_lookups():
+    if prompt_cache is None:
+        return None
+    stats = prompt_cache.stats()
+    return {"hit": stats["hits"], "miss": stats["misses"]}
+
+@metrics.gauge("markai_ledger_index_lookups_total", "In-memory ledger index lookups.",
+               labelnames=("result",), kind="counter")
+def read_ledger_index_lookups():
+    stats = open_ledger_index(LEDGER_PATH).stats()
+    return {"hit": stats["hits"], "miss": stats["misses"]}
+
+@metrics.gauge("markai_verify_cache_lookups_total", "Verification result cache lookups.",
+               labelnames=("result",), kind="counter")
+def read_verify_cache_lookups():
+    stats = verify_cache.stats()
+    return {"hit": stats["hits"], "miss": stats["misses"]}
+
+@metrics.gauge("markai_verify_cache_entries", "Verification results held in the cache.")
+def read_verify_cache_entries():
+    return verify_cache.stats()["entries"]
+
+@metrics.gauge("markai_jobs", "Asynchronous generation jobs by status.", labelnames=("status",))
+def read_jobs():
+    return generation_jobs.counts()
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Stage latency histograms and server gauges in Prometheus text format.
+    /verify/batch work runs in worker processes and is not included.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# ---------- BATCH VERIFICATION ----------
+
+_verify_pool = None
+_verify_pool_lock = threading.Lock()
+
+def get_verify_pool():
+    """Lazily starts the verification process pool (one worker per core by default)."""
+    global _verify_pool
+    with _verify_pool_lock:
+        if _verify_pool is None:
+            _verify_pool = ProcessPoolExecutor(max_workers=VERIFY_WORKERS, mp_context=verify_pool_context())
+        return _verify_pool
+
+def discard_verify_pool(pool):
+    """Drops a broken pool (a worker died) so the next batch starts a new one."""
+    global _verify_pool
+    with _verify_pool_lock:
+        if _verify_pool is pool:
+            _verify_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def submit_verifications(keys, uploads):
+    """Queues the uploads at the indexes in keys; returns (pool, futures)."""
+    pool = get_verify_pool()
+    try:
+        return pool, [pool.submit(verify_batch_item, index, uploads[index][0], uploads[index][1]) for index in keys]
+    except BrokenProcessPool:
+        discard_verify_pool(pool)
+        pool = get_verify_pool()
+        return pool, [pool.submit(verify_batch_item, index, uploads[index][0], uploads[index][1]) for index in keys]
+
+def read_batch_uploads():
+    """
+    Collects (filename, bytes) pairs from the 'images' multipart fields
+    and/or a zip file uploaded as 'archive'. Raises ValueError when the
+    batch has too many images or the archive would expand too far.
+    """
+    files = request.files.getlist('images')
+    if len(files) > MAX_VERIFY_BATCH:
+        raise ValueError(f"A batch can contain at most {MAX_VERIFY_BATCH} images")
+    uploads = [(file.filename, file.read()) for file in files]
     
-    for directory in [TEMP_DIR, GENERATED_DIR]:
-        if not os.path.exists(directory):
-            continue
-            
-        for filename in os.listdir(directory):
-            file_path = os.path.join(directory, filename)
+    archive_file = request.files.get('archive')
+    if archive_file is not None:
+        with zipfile.ZipFile(archive_file.stream) as archive:
+            # Decide from the central directory, before decompressing anything
+            entries = [entry for entry in archive.infolist() if not entry.is_dir()]
+            if len(uploads) + len(entries) > MAX_VERIFY_BATCH:
+                raise ValueError(f"A batch can contain at most {MAX_VERIFY_BATCH} images")
+            if sum(entry.file_size for entry in entries) > MAX_VERIFY_ARCHIVE_MB * 1024 * 1024:
+                raise ValueError(f"The archive expands to more than {MAX_VERIFY_ARCHIVE_MB} MB")
+            for entry in entries:
+                uploads.append((entry.filename, archive.read(entry)))
+    return uploads
+
+@app.route('/verify/batch', methods=['POST'])
+def verify_image_batch():
+    """
+    Verifies many images in parallel worker processes. Streams one JSON line
+    per image ({"index", "filename", "verification"} or {"index", "filename", "error"})
+    as soon as each finishes, in completion order. Cached results come first.
+    """
+    try:
+        uploads = read_batch_uploads()
+    except zipfile.BadZipFile as e:
+        return {"error": f"Invalid archive: {str(e)}"}, 400
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    
+    if not uploads:
+        return {"error": "No image files uploaded"}, 400
+    
+    cached = []
+    keys = {}
+    for index, (filename, data) in enumerate(uploads):
+        key = verify_cache.key(data)
+        result = verify_cache.get(key, is_recorded)
+        if result is not None:
+            cached.append({"index": index, "filename": filename, "verification": result})
+        else:
+            keys[index] = key
+    
+    pool, futures = submit_verifications(keys, uploads) if keys else (None, [])
+    indexes = dict(zip(futures, keys))
+    
+    def results():
+        for item in cached:
+            yield json.dumps(item, default=str) + "\n"
+        for future in as_completed(futures):
             try:
-                # Get file creation time
-                file_age = datetime.fromtimestamp(os.path.getctime(file_path))
-                hours_diff = (current_time - file_age).total_seconds() / 3600
-                
-                # Remove old files
-                if hours_diff > max_age_hours:
-                    os.remove(file_path)
-            except Exception as e:
-                print(f"Error cleaning up {file_path}: {str(e)}")
+                item = future.result()
+            except BrokenProcessPool:
+                discard_verify_pool(pool)
+                index = indexes[future]
+                item = {"index": index, "filename": uploads[index][0], "error": "Verification worker crashed"}
+            if "verification" in item:
+                cache_verification(keys[item["index"]], uploads[item["index"]][1], item["verification"])
+            yield json.dumps(item, default=str) + "\n"
+    
+    return Response(stream_with_context(results()), mimetype="application/x-ndjson")
+
+# Helper function to clean old temporary files
+def cleanup_temp_files(max_age_hours=STORAGE_RETENTION_HOURS):
+    """
+    Remove files older than max_age_hours. Whole expired buckets are
+    dropped, so unexpired files are never listed or stat'ed.
+    """
+    for store in [generated_store]:
+        try:
+            store.expire(max_age_hours * 3600)
+        except Exception as e:
+            print(f"Error cleaning up {store.root}: {str(e)}")
 
 # Set up periodic cleanup
 def setup_cleanup_scheduler():
@@ -470,18 +1132,31 @@ def setup_cleanup_scheduler():
     from apscheduler.schedulers.background import BackgroundScheduler
     
     scheduler = BackgroundScheduler()
-    scheduler.add_job(func=cleanup_temp_files, trigger="interval", hours=6)
+    scheduler.add_job(func=cleanup_temp_files, trigger="interval", seconds=STORAGE_BUCKET_SECONDS)
     scheduler.start()
     
     # Shut down the scheduler when exiting the app
     import atexit
     atexit.register(lambda: scheduler.shutdown())
 
+# Under a WSGI server the module is imported rather than run (verification
+# workers also import the main module, and must never load the model)
+if GENERATION_ENABLED and __name__ != '__main__' and multiprocessing.current_process().name == "MainProcess":
+    start_model_loading()
+
 if __name__ == '__main__':
-    # Create ledger file if it doesn't exist
-    if not os.path.exists(LEDGER_PATH):
-        with open(LEDGER_PATH, "w") as f:
-            json.dump({}, f)
+    import argparse
+    parser = argparse.ArgumentParser(description="MarkAI backend server")
+    parser.add_argument("--verify-only", action="store_true",
+                        help="Serve verification only; never import torch or load the model")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+    
+    if args.verify_only:
+        GENERATION_ENABLED = False
+        model_state["status"] = "disabled"
+    if GENERATION_ENABLED:
+        start_model_loading()
     
     # Set up cleanup scheduler
     try:
@@ -489,4 +1164,4 @@ if __name__ == '__main__':
     except ImportError:
         print("APScheduler not available. Skipping automated cleanup.")
     
-    app.run(port=5000)
\ No newline at end of file
+    app.run(port=args.port)
\ No newline at end of file
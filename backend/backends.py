@@ -0,0 +1,180 @@
+import os
+import json
+import tempfile
+
+# ---------- GENERATION BACKENDS ----------
+#
+# Device, dtype and model profile come from the environment, so the same
+# server runs on a CUDA GPU, Apple MPS or a CPU-only host:
+#   GENERATION_DEVICE       auto | cuda | mps | cpu
+#   GENERATION_DTYPE        auto | float16 | bfloat16 | float32
+#   MODEL_PROFILE           sd21 (Stable Diffusion 2.1) | tiny (random weights, offline)
+#   GENERATION_CPU_THREADS  intra-op threads on CPU (default: all cores)
+# torch and diffusers are imported inside the functions, never at import time.
+
+GENERATION_DEVICE = os.environ.get("GENERATION_DEVICE", "auto").lower()
+GENERATION_DTYPE = os.environ.get("GENERATION_DTYPE", "auto").lower()
+MODEL_PROFILE = os.environ.get("MODEL_PROFILE", "sd21").lower()
+GENERATION_CPU_THREADS = int(os.environ.get("GENERATION_CPU_THREADS", os.cpu_count() or 1))
+
+MODEL_PROFILES = {
+    "sd21": "stabilityai/stable-diffusion-2-1",
+    "tiny": "markai/tiny-random-sd",
+}
+
+def profile_model_id(profile=MODEL_PROFILE):
+    """The model name recorded in image metadata for a profile."""
+    if profile not in MODEL_PROFILES:
+        raise ValueError(f"Unknown MODEL_PROFILE: {profile} (expected one of {', '.join(MODEL_PROFILES)})")
+    return os.environ.get("MODEL_ID", MODEL_PROFILES[profile])
+
+def resolve_device(torch, requested=GENERATION_DEVICE):
+    if requested != "auto":
+        return requested
+    if torch.cuda.is_available():
+        return "cuda"
+    if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+def cpu_supports_bf16(torch):
+    """True when oneDNN has native bf16 kernels for this CPU (AVX512-BF16 / AMX)."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+def resolve_dtype(torch, device, requested=GENERATION_DTYPE):
+    if requested != "auto":
+        return getattr(torch, requested)
+    if device in ("cuda", "mps"):
+        return torch.float16
+    return torch.bfloat16 if cpu_supports_bf16(torch) else torch.float32
+
+def empty_cache(torch, device):
+    """Releases cached allocator memory on the generation device."""
+    if device == "cuda" and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
+    elif device == "mps" and hasattr(torch, "mps"):
+        torch.mps.empty_cache()
+
+# ---------- PIPELINE PROFILES ----------
+
+def _load_sd21(torch, model_id, dtype):
+    from diffusers import StableDiffusionPipeline
+    # The fp16 variant halves the download; weights are cast to dtype on load
+    return StableDiffusionPipeline.from_pretrained(
+        model_id,
+        torch_dtype=dtype,
+        use_safetensors=True,
+        variant="fp16"
+    )
+
+def _tiny_tokenizer():
+    """A byte-level CLIP tokenizer with no merges, built without any download."""
+    from transformers import CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    symbols = list(bytes_to_unicode().values())
+    vocab = {token: index for index, token in enumerate(
+        symbols + [symbol + "</w>" for symbol in symbols] + ["<|startoftext|>", "<|endoftext|>"])}
+
+    # The tokenizer reads both files when it is built, so they can go right after
+    with tempfile.TemporaryDirectory(prefix="markai-tiny-tokenizer-") as directory:
+        vocab_file = os.path.join(directory, "vocab.json")
+        merges_file = os.path.join(directory, "merges.txt")
+        with open(vocab_file, "w") as f:
+            json.dump(vocab, f)
+        with open(merges_file, "w") as f:
+            f.write("#version: 0.2\n")
+        return CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+
+def _load_tiny(torch, model_id, dtype):
+    """
+    Stable Diffusion with the real architecture at toy width and random
+    weights: same pipeline code path and latent scale, no network, runs on CPU.
+    """
+    from diffusers import StableDiffusionPipeline, UNet2DConditionModel, AutoencoderKL, DDIMScheduler
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    tokenizer = _tiny_tokenizer()
+    # Weights are drawn from a fixed seed, and the process-wide RNG state is
+    # restored afterwards so the tiny profile never changes anyone else's draws
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(0)
+        text_encoder = CLIPTextModel(CLIPTextConfig(
+            vocab_size=len(tokenizer),
+            hidden_size=32,
+            intermediate_size=37,
+            num_attention_heads=4,
+            num_hidden_layers=2,
+            max_position_embeddings=77,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id
+        ))
+        unet = UNet2DConditionModel(
+            block_out_channels=(32, 64),
+            layers_per_block=1,
+            sample_size=64,
+            in_channels=4,
+            out_channels=4,
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+            up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+            cross_attention_dim=32,
+            attention_head_dim=4
+        )
+        # Four VAE levels keep SD's 8x latent scale, so a 512x512 image is a 64x64 latent
+        vae = AutoencoderKL(
+            block_out_channels=(32, 32, 32, 32),
+            in_channels=3,
+            out_channels=3,
+            down_block_types=("DownEncoderBlock2D",) * 4,
+            up_block_types=("UpDecoderBlock2D",) * 4,
+            latent_channels=4,
+            layers_per_block=1
+        )
+    scheduler = DDIMScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        clip_sample=False,
+        set_alpha_to_one=False
+    )
+    pipeline = StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    )
+    return pipeline.to(dtype)
+
+PIPELINE_LOADERS = {
+    "sd21": _load_sd21,
+    "tiny": _load_tiny,
+}
+
+def load_pipeline(torch, profile=MODEL_PROFILE, device=GENERATION_DEVICE, dtype=GENERATION_DTYPE):
+    """
+    Builds the pipeline for profile and tunes it for the resolved device.
+    Returns (pipeline, device, dtype).
+    """
+    device = resolve_device(torch, device)
+    dtype = resolve_dtype(torch, device, dtype)
+    pipeline = PIPELINE_LOADERS[profile](torch, profile_model_id(profile), dtype).to(device)
+
+    if device == "cuda":
+        # Enable memory efficient attention and VAE slicing for limited VRAM
+        pipeline.enable_attention_slicing()
+        pipeline.enable_vae_slicing()
+    elif device == "cpu":
+        # oneDNN convolutions are fastest on NHWC tensors
+        torch.set_num_threads(GENERATION_CPU_THREADS)
+        pipeline.unet.to(memory_format=torch.channels_last)
+        pipeline.vae.to(memory_format=torch.channels_last)
+    return pipeline, device, dtype
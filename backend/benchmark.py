@@ -0,0 +1,334 @@
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import hashlib
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+IMAGE_SIZES = [256, 512, 1024, 2048, 4096]
+LEDGER_SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+QUICK_IMAGE_SIZES = [256, 512]
+QUICK_LEDGER_SIZES = [10 ** 3, 10 ** 4]
+
+RESULTS_PATH = "benchmark_results.jsonl"
+
+# ---------- HELPERS ----------
+
+class StubPipeline:
+    """Stands in for StableDiffusionPipeline: returns smooth random images instantly."""
+
+    def __call__(self, prompt_embeds=None, num_images_per_prompt=1, width=512, height=512, **kwargs):
+        count = len(prompt_embeds) * num_images_per_prompt
+        return type("Output", (), {"images": [sample_image(width, height) for _ in range(count)]})
+
+class StubPromptCache:
+    def batch(self, prompts):
+        return list(prompts), list(prompts)
+
+    def stats(self):
+        return {"entries": 0, "max_size": 0, "hits": 0, "misses": 0}
+
+def sample_image(width, height, seed=0):
+    """A photo-like test image: smooth colour regions plus sensor noise."""
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (height // 32 + 1, width // 32 + 1, 3), dtype=np.uint8)
+    smooth = np.asarray(Image.fromarray(coarse).resize((width, height), Image.BICUBIC), dtype=np.int16)
+    noisy = smooth + rng.integers(-4, 5, smooth.shape, dtype=np.int16)
+    return Image.fromarray(np.clip(noisy, 0, 255).astype(np.uint8))
+
+def measure(func, min_runs=3, min_seconds=0.5, max_runs=200):
+    """Runs func repeatedly; returns per-call timings in milliseconds."""
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_runs and (len(timings) < min_runs or time.perf_counter() - started < min_seconds):
+        t0 = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - t0) * 1000)
+    return timings
+
+def summarize(stage, param, value, timings):
+    return {
+        "stage": stage,
+        "param": param,
+        "value": value,
+        "runs": len(timings),
+        "mean_ms": round(float(np.mean(timings)), 4),
+        "median_ms": round(float(np.median(timings)), 4),
+        "min_ms": round(float(np.min(timings)), 4),
+    }
+
+def report(result):
+    print(f"{result['stage']:<32} {result['param']}={result['value']:<10} "
+          f"median {result['median_ms']:>10.3f} ms  (runs: {result['runs']})")
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+def fill_ledger(ledger, count, batch_size=50000):
+    """Bulk-loads count random entries into a fresh ledger."""
+    record = {"timestamp": datetime.now().isoformat(), "status": "Verified"}
+    for start in range(0, count, batch_size):
+        entries = [(uuid.uuid4().hex + uuid.uuid4().hex, record)
+                   for _ in range(min(batch_size, count - start))]
+        ledger.append_many(entries)
+
+# ---------- BENCHMARKS ----------
+
+def reject_unmarked(image):
+    """lsb_reveal on an image without a watermark (ends in the header check)."""
+    from watermark import lsb_reveal
+    try:
+        lsb_reveal(image)
+    except ValueError:
+        pass
+
+def bench_image_stages(app, verification, sizes):
+    """Pixel and metadata stages as the image grows."""
+    results = []
+    for size in sizes:
+        image = sample_image(size, size)
+        metadata = {
+            "ImageID": str(uuid.uuid4()),
+            "GenerationPrompt": "benchmark prompt",
+            "GenerationDate": datetime.now().isoformat(),
+            "GeneratedBy": app.model_id
+        }
+        watermark = verification.watermark_payload_for(metadata)
+        watermark_text = verification.watermark_text_for(metadata)
+
+        steg_image = app.embed_steganographic_watermark(image, watermark)
+        png_bytes, _ = app.embed_metadata(steg_image, dict(metadata))
+        secured = Image.open(io.BytesIO(png_bytes))
+        secured.load()
+        legacy = app.embed_steganographic_watermark(image, watermark_text)
+
+        stages = [
+            ("embed_frequency_watermark", lambda: app.embed_frequency_watermark(image)),
+            ("embed_steganographic_watermark", lambda: app.embed_steganographic_watermark(image, watermark)),
+            ("extract_watermark", lambda: verification.extract_watermark(secured)),
+            ("extract_watermark (text format)", lambda: verification.extract_watermark(legacy)),
+            ("lsb_reveal (unmarked)", lambda: reject_unmarked(image)),
+            ("embed_metadata", lambda: app.embed_metadata(steg_image, dict(metadata))),
+            ("verify_image_bytes", lambda: verification.verify_image_bytes(png_bytes)),
+        ]
+        for stage, func in stages:
+            result = summarize(stage, "pixels", f"{size}x{size}", measure(func))
+            report(result)
+            results.append(result)
+
+        # Recorded in the ledger with its digest, the image takes the metadata-only path
+        app.save_hash_to_ledger(secured.info["TamperCheckHash"], content_digest=hashlib.sha256(png_bytes).hexdigest())
+        result = summarize("verify_image_bytes (recorded)", "pixels", f"{size}x{size}",
+                           measure(lambda: verification.verify_image_bytes(png_bytes)))
+        report(result)
+        results.append(result)
+
+        client = app.app.test_client()
+        def post_verify():
+            response = client.post('/verify', data={'image': (io.BytesIO(png_bytes), 'image.png')})
+            assert response.status_code == 200, response.data
+        # VERIFY_CACHE_SIZE=0 in main(): every request runs the handler
+        result = summarize("/verify", "pixels", f"{size}x{size}", measure(post_verify))
+        report(result)
+        results.append(result)
+
+        uncached, app.verify_cache = app.verify_cache, app.VerificationCache()
+        try:
+            result = summarize("/verify (cached)", "pixels", f"{size}x{size}", measure(post_verify))
+        finally:
+            app.verify_cache = uncached
+        report(result)
+        results.append(result)
+    return results
+
+def bench_metadata_hash(app, verification):
+    metadata = {
+        "ImageID": str(uuid.uuid4()),
+        "GenerationPrompt": "benchmark prompt " * 25,
+        "GenerationDate": datetime.now().isoformat(),
+        "GeneratedBy": app.model_id
+    }
+    result = summarize("compute_metadata_hash", "fields", len(metadata),
+                       measure(lambda: verification.compute_metadata_hash(metadata), min_runs=1000))
+    report(result)
+    return [result]
+
+def bench_ledger(app, verification, ledger_sizes, workdir):
+    """Ledger append and lookup cost as the number of recorded images grows."""
+    results = []
+    metadata = {
+        "ImageID": str(uuid.uuid4()),
+        "GenerationPrompt": "benchmark prompt",
+        "GenerationDate": datetime.now().isoformat(),
+        "GeneratedBy": app.model_id
+    }
+    png_bytes, _ = app.embed_metadata(
+        app.embed_steganographic_watermark(sample_image(512, 512), verification.watermark_payload_for(metadata)), metadata)
+    image = Image.open(io.BytesIO(png_bytes))
+    image.load()
+    for count in ledger_sizes:
+        path = os.path.join(workdir, f"ledger_{count}.db")
+        ledger = app.open_ledger(path)
+        print(f"Filling ledger with {count} entries...")
+        fill_ledger(ledger, count)
+
+        result = summarize("save_hash_to_ledger", "entries", count,
+                           measure(lambda: app.save_hash_to_ledger(uuid.uuid4().hex * 2, ledger_path=path)))
+        report(result)
+        results.append(result)
+
+        # Cold: first lookup builds the in-memory index from the store
+        index = app.open_ledger_index(path)
+        t0 = time.perf_counter()
+        index.refresh()
+        result = summarize("ledger_index_load", "entries", count, [(time.perf_counter() - t0) * 1000])
+        report(result)
+        results.append(result)
+
+        known = random.choice([h for h, _ in ledger.read_since(count - 10)[0]])
+        result = summarize("ledger_lookup_hit", "entries", count,
+                           measure(lambda: index.lookup(known), min_runs=1000))
+        report(result)
+        results.append(result)
+        result = summarize("ledger_lookup_miss", "entries", count,
+                           measure(lambda: index.lookup(uuid.uuid4().hex), min_runs=1000))
+        report(result)
+        results.append(result)
+
+        result = summarize("verify_image_object", "entries", count,
+                           measure(lambda: verification.verify_image_object(image, ledger_path=path)))
+        report(result)
+        results.append(result)
+    return results
+
+def bench_generate(app, sizes, steps=1, label="stub model"):
+    """The whole /generate path with the stub pipeline or the tiny model profile."""
+    results = []
+    client = app.app.test_client()
+    for size in sizes:
+        if size * size > 512 * 512:
+            continue
+        def post_generate():
+            response = client.post('/generate', json={"prompt": "benchmark", "width": size, "height": size, "steps": steps})
+            assert response.status_code == 200, response.data
+        result = summarize(f"/generate ({label})", "pixels", f"{size}x{size}", measure(post_generate))
+        report(result)
+        results.append(result)
+    return results
+
+# ---------- RESULT HISTORY ----------
+
+def load_previous_run(path):
+    if not os.path.exists(path):
+        return None
+    last = None
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                last = json.loads(line)
+    return last
+
+def compare(previous, current, threshold=0.10):
+    """Prints stages that got slower or faster than the previous run by threshold."""
+    before = {(r["stage"], str(r["value"])): r["median_ms"] for r in previous["results"]}
+    print(f"\n===== Compared with {previous.get('commit') or 'previous run'} ({previous['timestamp']}) =====")
+    changed = False
+    for result in current["results"]:
+        old = before.get((result["stage"], str(result["value"])))
+        if not old:
+            continue
+        change = (result["median_ms"] - old) / old
+        if abs(change) >= threshold:
+            changed = True
+            label = "SLOWER" if change > 0 else "faster"
+            print(f"{label:<7} {result['stage']:<32} {result['value']:<10} "
+                  f"{old:.3f} -> {result['median_ms']:.3f} ms ({change:+.0%})")
+    if not changed:
+        print(f"No stage changed by more than {threshold:.0%}")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the MarkAI security pipeline on CPU. The server is imported in "
+                    "verify-only mode with a stub in place of Stable Diffusion, and every run is "
+                    "appended to a JSONL history and compared with the previous run."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", help="Square image sizes in pixels")
+    parser.add_argument("--ledger-sizes", type=int, nargs="+", help="Ledger entry counts")
+    parser.add_argument("--quick", action="store_true", help="Only the smallest sizes")
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSONL history file to append to")
+    parser.add_argument("--label", help="Free-form label stored with this run")
+    parser.add_argument("--tiny-model", action="store_true",
+                        help="Run /generate through the random-weight tiny model profile (needs torch and "
+                             "diffusers, no GPU or network) instead of the stub")
+    parser.add_argument("--steps", type=int, default=1, help="Inference steps per /generate call")
+    args = parser.parse_args()
+
+    sizes = args.sizes or (QUICK_IMAGE_SIZES if args.quick else IMAGE_SIZES)
+    ledger_sizes = args.ledger_sizes or (QUICK_LEDGER_SIZES if args.quick else LEDGER_SIZES)
+    results_path = os.path.abspath(args.results)
+
+    commit = git_commit()
+    workdir = tempfile.mkdtemp(prefix="markai-bench-")
+    os.environ["GENERATION_ENABLED"] = "0"
+    os.environ["LEDGER_PATH"] = os.path.join(workdir, "image_ledger.db")
+    os.environ["PHASH_INDEX_PATH"] = os.path.join(workdir, "phash_index.db")
+    os.environ["IMAGE_CATALOG_PATH"] = os.path.join(workdir, "image_catalog.db")
+    # Stages measure the work itself, not repeated cache hits or the group-commit wait
+    os.environ["VERIFY_CACHE_SIZE"] = "0"
+    os.environ["LEDGER_COMMIT_WINDOW_MS"] = "0"
+    if args.tiny_model:
+        os.environ["MODEL_PROFILE"] = "tiny"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+
+    import app
+    import verification
+
+    if args.tiny_model:
+        app.load_model()
+    else:
+        # Swap the stub pipeline in for the real model
+        app.model = StubPipeline()
+        app.prompt_cache = StubPromptCache()
+    app.model_state["status"] = "ready"
+
+    results = []
+    results += bench_metadata_hash(app, verification)
+    results += bench_image_stages(app, verification, sizes)
+    results += bench_generate(app, sizes, args.steps, "tiny model" if args.tiny_model else "stub model")
+    results += bench_ledger(app, verification, ledger_sizes, workdir)
+
+    run = {
+        "timestamp": datetime.now().isoformat(),
+        "commit": commit,
+        "label": args.label,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "generation": {k: app.model_state[k] for k in ("device", "dtype")},
+        "results": results,
+    }
+
+    previous = load_previous_run(results_path)
+    with open(results_path, "a") as f:
+        f.write(json.dumps(run) + "\n")
+    print(f"\nResults appended to {results_path}")
+    if previous:
+        compare(previous, run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import os
+import sqlite3
+import weakref
+import threading
+
+# ---------- FORK SAFETY ----------
+#
+# Stores keep SQLite connections and locks at module level. A forked child
+# (a verification or audit worker) inherits them in whatever state the
+# parent's other threads left them, so each store registers a hook that
+# gives the child its own. Windows has no fork: workers there are spawned
+# and import the stores afresh.
+
+def after_fork(func):
+    """Registers func to run in the child after every fork; usable as a decorator."""
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=func)
+    return func
+
+# ---------- THREAD-LOCAL SQLITE CONNECTIONS ----------
+
+class _ThreadLocalConnection:
+    """Callable returning the calling thread's connection, opened on first use."""
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.local = threading.local()
+        self.inherited = []
+
+    def __call__(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            if self.schema is not None:
+                self.schema(conn)
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+# Every open store's connections, so a forked child can be given fresh ones
+_connections = weakref.WeakSet()
+
+def thread_local_connection(path, schema=None):
+    """
+    Returns connect(), which gives each thread its own connection to the SQLite
+    database at path (sqlite3 connections must not be shared between threads).
+    A connection is opened in WAL mode and schema(conn) is run on it first.
+    """
+    connect = _ThreadLocalConnection(path, schema)
+    _connections.add(connect)
+    return connect
+
+@after_fork
+def _reset_connections():
+    # The inherited connections stay referenced so the child never closes them
+    for connect in list(_connections):
+        connect.inherited.append(connect.local)
+        connect.local = threading.local()
@@ -0,0 +1,125 @@
+import time
+import uuid
+import threading
+
+# ---------- ASYNCHRONOUS GENERATION JOBS ----------
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+FINISHED_STATES = (JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED)
+
+class GenerationCancelled(Exception):
+    """Raised from the step callback to stop a batch nobody is waiting for."""
+
+class Job:
+    """
+    State of one asynchronous generation. Every change bumps version and
+    wakes anyone blocked in wait_for_change (e.g. an SSE stream).
+    """
+
+    def __init__(self, prompt, total_steps):
+        self.id = str(uuid.uuid4())
+        self.prompt = prompt
+        self.status = JOB_QUEUED
+        self.step = 0
+        self.total_steps = total_steps
+        self.error = None
+        self.result = None
+        self.image_id = None
+        self.future = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.version = 0
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    @property
+    def cancelled(self):
+        return self.status == JOB_CANCELLED
+
+    def _update(self, **changes):
+        with self._cond:
+            if self.finished:
+                return False
+            for name, value in changes.items():
+                setattr(self, name, value)
+            if self.finished:
+                self.finished_at = time.time()
+            self.version += 1
+            self._cond.notify_all()
+            return True
+
+    def set_progress(self, step):
+        self._update(status=JOB_RUNNING, step=step)
+
+    def succeed(self, result, image_id=None):
+        self._update(status=JOB_SUCCEEDED, step=self.total_steps, result=result, image_id=image_id)
+
+    def fail(self, error):
+        self._update(status=JOB_FAILED, error=error)
+
+    def cancel(self):
+        """Cancels the job; a job still queued never reaches the model."""
+        if not self._update(status=JOB_CANCELLED):
+            return False
+        if self.future is not None:
+            self.future.cancel()
+        return True
+
+    def wait_for_change(self, version, timeout):
+        """Blocks until the job changes past version or timeout expires."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "progress": round(self.step / self.total_steps, 4) if self.total_steps else 0.0,
+            "error": self.error,
+            "image_id": self.image_id,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+class JobStore:
+    """In-memory job registry; finished jobs are dropped after ttl seconds."""
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
@@ -0,0 +1,574 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import Future
+from connections import after_fork, thread_local_connection
+
+# Path of the ledger store; the file extension selects the backend
+LEDGER_PATH = os.environ.get("LEDGER_PATH", "image_ledger.db")
+
+# Ledger written by earlier versions (one JSON object rewritten on every save);
+# a new SQLite ledger imports the file of this name found next to it
+LEGACY_LEDGER_PATH = "image_ledger.json"
+
+# Group commit: appends arriving within this window share one transaction
+# and one Merkle batch (at most MERKLE_BATCH_SIZE leaves per batch)
+LEDGER_COMMIT_WINDOW_MS = float(os.environ.get("LEDGER_COMMIT_WINDOW_MS", 10))
+MERKLE_BATCH_SIZE = int(os.environ.get("MERKLE_BATCH_SIZE", 1024))
+
+# ---------- MERKLE BATCHES ----------
+#
+# Every committed batch of hashes is sealed under a Merkle root, and each
+# root is chained to the previous one: chain_root = SHA-256(prev_chain || root).
+# An image's inclusion proof is the list of sibling hashes from its leaf to
+# its batch root, so a verifier only needs the (small) list of batch roots.
+
+GENESIS_ROOT = "00" * 32
+
+def merkle_leaf(image_hash):
+    return hashlib.sha256(b"\x00" + image_hash.encode()).digest()
+
+def _merkle_node(left, right):
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+def _merkle_levels(leaves):
+    """All tree levels from the leaves up; an odd last node is carried up unchanged."""
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [_merkle_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+def merkle_root(leaves):
+    return _merkle_levels(leaves)[-1][0].hex()
+
+def merkle_proof(leaves, index):
+    """Sibling path of leaf index as [["left"|"right", sibling_hex], ...]."""
+    proof = []
+    for level in _merkle_levels(leaves)[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(["left" if sibling < index else "right", level[sibling].hex()])
+        index //= 2
+    return proof
+
+def chain_root(prev_chain_root, root):
+    return hashlib.sha256(bytes.fromhex(prev_chain_root) + bytes.fromhex(root)).hexdigest()
+
+def verify_merkle_proof(image_hash, proof, root):
+    """True if proof leads from image_hash to the Merkle root."""
+    node = merkle_leaf(image_hash)
+    for side, sibling in proof:
+        sibling = bytes.fromhex(sibling)
+        node = _merkle_node(sibling, node) if side == "left" else _merkle_node(node, sibling)
+    return node.hex() == root
+
+def verify_root_chain(roots):
+    """True if every batch root in roots (ordered by batch_id) chains to the previous one."""
+    prev = GENESIS_ROOT
+    for batch in roots:
+        if batch["prev_chain_root"] != prev or chain_root(prev, batch["merkle_root"]) != batch["chain_root"]:
+            return False
+        prev = batch["chain_root"]
+    return True
+
+def verify_inclusion(proof, roots):
+    """
+    Checks an inclusion proof (as returned by SqliteLedger.proof) against a
+    list of batch roots, without access to the ledger itself.
+    """
+    batch = next((b for b in roots if b["batch_id"] == proof["batch_id"]), None)
+    return (batch is not None
+            and batch["merkle_root"] == proof["merkle_root"]
+            and verify_merkle_proof(proof["image_hash"], proof["proof"], batch["merkle_root"]))
+
+class GroupCommitter:
+    """
+    Collects single appends for up to window seconds (or max_batch entries)
+    and hands them to commit(entries) together, which returns the set of
+    hashes that were new. Each append waits for its batch to be durable.
+    """
+
+    def __init__(self, commit, window, max_batch, name="ledger-commit"):
+        self.commit = commit
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._cond = threading.Condition()
+        self.batches = 0
+        threading.Thread(target=self._worker, name=name, daemon=True).start()
+
+    def submit(self, image_hash, record):
+        future = Future()
+        with self._cond:
+            if not self._pending:
+                self._first_at = time.monotonic()
+            self._pending.append((image_hash, record, future))
+            self._cond.notify()
+        return future
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                while len(self._pending) < self.max_batch:
+                    remaining = self._first_at + self.window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                self._first_at = time.monotonic()
+            try:
+                new = self.commit([(image_hash, record) for image_hash, record, _ in batch])
+                for image_hash, _, future in batch:
+                    future.set_result(image_hash in new)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+            self.batches += 1
+
+# ---------- LEGACY JSON BACKEND ----------
+
+class JsonLedger:
+    """
+    Whole-file JSON ledger as written by earlier versions.
+    Every append rewrites the file, so it is only suitable for small ledgers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                # Handle corrupted ledger
+                return {}
+
+    def append(self, image_hash, record):
+        lock_file = f"{self.path}.lock"
+
+        # Simple file-based locking
+        retry_count = 0
+        while os.path.exists(lock_file) and retry_count < 5:
+            time.sleep(0.5)
+            retry_count += 1
+
+        try:
+            with open(lock_file, 'w') as f:
+                f.write('locked')
+
+            ledger = self._load()
+            ledger[image_hash] = record
+
+            with open(self.path, "w") as f:
+                json.dump(ledger, f, indent=4)
+            return True
+        finally:
+            if os.path.exists(lock_file):
+                os.remove(lock_file)
+
+    def get(self, image_hash):
+        return self._load().get(image_hash)
+
+    def read_since(self, cursor):
+        """
+        Returns (entries, cursor, reset) for LedgerIndex. The whole file is
+        rewritten on every append, so any change means a full reload.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return [], None, cursor is not None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == cursor:
+            return [], cursor, False
+        return list(self._load().items()), signature, True
+
+    def items(self):
+        return iter(self._load().items())
+
+    def __contains__(self, image_hash):
+        return image_hash in self._load()
+
+    def __len__(self):
+        return len(self._load())
+
+# ---------- SQLITE BACKEND ----------
+
+class SqliteLedger:
+    """
+    Append-only ledger stored in SQLite (WAL mode).
+    Appends are a single indexed insert and lookups hit the primary key index,
+    so neither depends on the number of images already recorded. Appends are
+    group-committed in Merkle batches whose roots are chained in `batches`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connect = thread_local_connection(path, self._create_schema)
+        self._committer = None
+        self._committer_lock = threading.Lock()
+        created = not os.path.exists(path)
+        self._connect()
+
+        # A new store starts from the legacy JSON ledger, if there is one.
+        # Imports are idempotent, so processes racing to create it are harmless.
+        legacy_path = legacy_ledger_path(path)
+        if created and os.path.exists(legacy_path):
+            imported = migrate_json_ledger(legacy_path, self)
+            print(f"Imported {imported} entries from {legacy_path}")
+
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS ledger ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "image_hash TEXT NOT NULL UNIQUE, "
+            "record TEXT NOT NULL)"
+        )
+        # Ledgers created before Merkle batching lack the batch columns
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(ledger)")}
+        if "batch_id" not in columns:
+            conn.execute("ALTER TABLE ledger ADD COLUMN batch_id INTEGER")
+            conn.execute("ALTER TABLE ledger ADD COLUMN leaf_index INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS ledger_batch ON ledger (batch_id, leaf_index)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            "batch_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "merkle_root TEXT NOT NULL, "
+            "prev_chain_root TEXT NOT NULL, "
+            "chain_root TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "sealed_at TEXT NOT NULL)"
+        )
+
+    def append(self, image_hash, record):
+        """
+        Records image_hash; an existing entry is never overwritten.
+        Returns once the group commit holding the entry is written.
+        """
+        with self._committer_lock:
+            if self._committer is None:
+                self._committer = GroupCommitter(self._commit_batch, LEDGER_COMMIT_WINDOW_MS / 1000, MERKLE_BATCH_SIZE)
+        return self._committer.submit(image_hash, record).result()
+
+    def append_many(self, entries):
+        """Records several hashes in sealed batches; returns how many were new."""
+        entries = list(entries)
+        return sum(len(self._commit_batch(entries[start:start + MERKLE_BATCH_SIZE]))
+                   for start in range(0, len(entries), MERKLE_BATCH_SIZE))
+
+    def _commit_batch(self, entries):
+        """Inserts entries and seals the new ones as one Merkle batch; returns the new hashes."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            new = []
+            for image_hash, record in entries:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO ledger (image_hash, record) VALUES (?, ?)",
+                    (image_hash, json.dumps(record))
+                )
+                if cursor.rowcount:
+                    new.append(image_hash)
+            if new:
+                self._seal(conn, new)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return set(new)
+
+    def _seal(self, conn, hashes):
+        """Chains a Merkle batch over hashes (already inserted) to the latest root."""
+        root = merkle_root([merkle_leaf(image_hash) for image_hash in hashes])
+        latest = conn.execute("SELECT chain_root FROM batches ORDER BY batch_id DESC LIMIT 1").fetchone()
+        prev = latest[0] if latest else GENESIS_ROOT
+        batch_id = conn.execute(
+            "INSERT INTO batches (merkle_root, prev_chain_root, chain_root, size, sealed_at) VALUES (?, ?, ?, ?, ?)",
+            (root, prev, chain_root(prev, root), len(hashes), time.strftime("%Y-%m-%dT%H:%M:%S"))
+        ).lastrowid
+        conn.executemany(
+            "UPDATE ledger SET batch_id = ?, leaf_index = ? WHERE image_hash = ?",
+            ((batch_id, index, image_hash) for index, image_hash in enumerate(hashes))
+        )
+
+    def seal_unbatched(self):
+        """Seals entries written before Merkle batching; returns how many were sealed."""
+        sealed = 0
+        conn = self._connect()
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                hashes = [row[0] for row in conn.execute(
+                    "SELECT image_hash FROM ledger WHERE batch_id IS NULL ORDER BY seq LIMIT ?",
+                    (MERKLE_BATCH_SIZE,)
+                )]
+                if hashes:
+                    self._seal(conn, hashes)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if not hashes:
+                return sealed
+            sealed += len(hashes)
+
+    def proof(self, image_hash):
+        """Inclusion proof of image_hash in its batch, or None if not sealed."""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT batch_id, leaf_index FROM ledger WHERE image_hash = ?", (image_hash,)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        batch_id, leaf_index = row
+        leaves = [merkle_leaf(h) for (h,) in conn.execute(
+            "SELECT image_hash FROM ledger WHERE batch_id = ? ORDER BY leaf_index", (batch_id,)
+        )]
+        merkle_root_hex, chain = conn.execute(
+            "SELECT merkle_root, chain_root FROM batches WHERE batch_id = ?", (batch_id,)
+        ).fetchone()
+        return {
+            "image_hash": image_hash,
+            "batch_id": batch_id,
+            "leaf_index": leaf_index,
+            "proof": merkle_proof(leaves, leaf_index),
+            "merkle_root": merkle_root_hex,
+            "chain_root": chain,
+        }
+
+    def roots(self, since=0):
+        """Batch roots after batch_id since, oldest first."""
+        rows = self._connect().execute(
+            "SELECT batch_id, merkle_root, prev_chain_root, chain_root, size, sealed_at "
+            "FROM batches WHERE batch_id > ? ORDER BY batch_id", (since,)
+        ).fetchall()
+        return [{
+            "batch_id": batch_id,
+            "merkle_root": root,
+            "prev_chain_root": prev,
+            "chain_root": chain,
+            "size": size,
+            "sealed_at": sealed_at,
+        } for batch_id, root, prev, chain, size, sealed_at in rows]
+
+    def get(self, image_hash):
+        row = self._connect().execute(
+            "SELECT record FROM ledger WHERE image_hash = ?", (image_hash,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def read_since(self, cursor):
+        """Returns (entries, cursor, reset) with the entries appended after cursor."""
+        rows = self._connect().execute(
+            "SELECT seq, image_hash, record FROM ledger WHERE seq > ? ORDER BY seq",
+            (cursor or 0,)
+        ).fetchall()
+        if not rows:
+            return [], cursor, False
+        return [(image_hash, json.loads(record)) for _, image_hash, record in rows], rows[-1][0], False
+
+    def items(self):
+        rows = self._connect().execute("SELECT image_hash, record FROM ledger ORDER BY seq")
+        for image_hash, record in rows:
+            yield image_hash, json.loads(record)
+
+    def __contains__(self, image_hash):
+        return self._connect().execute(
+            "SELECT 1 FROM ledger WHERE image_hash = ?", (image_hash,)
+        ).fetchone() is not None
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM ledger").fetchone()[0]
+
+# ---------- IN-MEMORY LOOKUP INDEX ----------
+
+class LedgerIndex:
+    """
+    In-memory hash -> timestamp index over a ledger store.
+    Entries are only ever appended, so hits are answered from memory and the
+    store is only consulted on a miss, reading just what was appended since
+    the last refresh (or reloading when a legacy JSON file changed).
+    """
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self._index = {}
+        self._cursor = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.refreshes = 0
+
+    def refresh(self):
+        """Pulls new entries from the store; returns True if anything changed."""
+        with self._lock:
+            entries, cursor, reset = self.ledger.read_since(self._cursor)
+            reset = reset or (self._cursor is None and bool(entries))
+            self._cursor = cursor
+            if not reset and not entries:
+                return False
+
+            # Build a full reload on the side so concurrent lookups never see it half done
+            index = {} if reset else self._index
+            for image_hash, record in entries:
+                index[image_hash] = record.get("timestamp") if isinstance(record, dict) else None
+            self._index = index
+
+            if reset:
+                self.reloads += 1
+            else:
+                self.refreshes += 1
+            return True
+
+    def lookup(self, image_hash):
+        """Returns (found, timestamp); timestamp is None for legacy entries."""
+        if image_hash in self._index:
+            self.hits += 1
+            return True, self._index[image_hash]
+        if self.refresh() and image_hash in self._index:
+            self.hits += 1
+            return True, self._index[image_hash]
+        self.misses += 1
+        return False, None
+
+    def __contains__(self, image_hash):
+        return self.lookup(image_hash)[0]
+
+    def __len__(self):
+        return len(self._index)
+
+    def stats(self):
+        return {
+            "entries": len(self._index),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "refreshes": self.refreshes,
+        }
+
+# ---------- BACKEND SELECTION ----------
+
+LEDGER_BACKENDS = {
+    ".json": JsonLedger,
+    ".db": SqliteLedger,
+    ".sqlite": SqliteLedger,
+}
+
+_ledgers = {}
+_indexes = {}
+_ledgers_lock = threading.Lock()
+
+def legacy_ledger_path(path):
+    """The legacy JSON ledger imported by a new ledger at path."""
+    return os.path.join(os.path.dirname(path), os.path.basename(LEGACY_LEDGER_PATH))
+
+def open_ledger(path=LEDGER_PATH, create=True):
+    """
+    Returns the (shared) ledger for path, picking the backend by extension.
+    With create=False (read-only callers) a missing store is not created:
+    the legacy JSON ledger next to it is read instead, or nothing if absent.
+    """
+    with _ledgers_lock:
+        if path not in _ledgers:
+            ext = os.path.splitext(path)[1].lower()
+            if ext not in LEDGER_BACKENDS:
+                raise ValueError(f"Unsupported ledger type: {path}")
+            if not create and not os.path.exists(path):
+                _ledgers[path] = JsonLedger(legacy_ledger_path(path) if ext != ".json" else path)
+            else:
+                _ledgers[path] = LEDGER_BACKENDS[ext](path)
+        return _ledgers[path]
+
+def open_ledger_index(path=LEDGER_PATH):
+    """Returns the shared in-memory lookup index for the ledger at path."""
+    ledger = open_ledger(path)
+    with _ledgers_lock:
+        if path not in _indexes:
+            _indexes[path] = LedgerIndex(ledger)
+        return _indexes[path]
+
+# Ledgers inherited through fork; kept referenced so the child never closes them
+_inherited_ledgers = []
+
+@after_fork
+def _reset_after_fork():
+    """
+    Gives a forked child (e.g. a verification worker) its own ledgers, without
+    the parent's group committer and its locks. The parent's lookup index is
+    kept and simply continues from its cursor.
+    """
+    global _ledgers_lock
+    _ledgers_lock = threading.Lock()
+    _inherited_ledgers.extend(_ledgers.values())
+    for path, ledger in list(_ledgers.items()):
+        _ledgers[path] = type(ledger)(ledger.path)
+    for path, index in _indexes.items():
+        index.ledger = _ledgers[path]
+        index._lock = threading.Lock()
+
+def migrate_json_ledger(source_path, ledger, batch_size=10000):
+    """Imports every entry of a legacy JSON ledger; returns how many were new."""
+    with open(source_path, "r") as f:
+        entries = list(json.load(f).items())
+
+    if not hasattr(ledger, "append_many"):
+        return sum(1 for image_hash, record in entries if ledger.append(image_hash, record))
+
+    imported = 0
+    for start in range(0, len(entries), batch_size):
+        imported += ledger.append_many(entries[start:start + batch_size])
+    return imported
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the image ledger")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate = subparsers.add_parser("migrate", help="Import a legacy JSON ledger")
+    migrate.add_argument("--source", default=LEGACY_LEDGER_PATH, help="Legacy JSON ledger to import")
+    migrate.add_argument("--target", default=LEDGER_PATH, help="Ledger to import into")
+
+    seal = subparsers.add_parser("seal", help="Seal entries written before Merkle batching")
+    seal.add_argument("--ledger", default=LEDGER_PATH)
+
+    roots = subparsers.add_parser("roots", help="Export the chained batch roots for offline verification")
+    roots.add_argument("--ledger", default=LEDGER_PATH)
+    roots.add_argument("--output", default="-", help="File to write (default: stdout)")
+
+    proof = subparsers.add_parser("proof", help="Print the inclusion proof of an image hash")
+    proof.add_argument("image_hash")
+    proof.add_argument("--ledger", default=LEDGER_PATH)
+
+    args = parser.parse_args()
+    if args.command == "migrate":
+        ledger = open_ledger(args.target)
+        imported = migrate_json_ledger(args.source, ledger)
+        print(f"Imported {imported} new entries into {args.target} ({len(ledger)} total)")
+    elif args.command == "seal":
+        print(f"Sealed {open_ledger(args.ledger).seal_unbatched()} entries")
+    elif args.command == "roots":
+        output = json.dumps(open_ledger(args.ledger).roots(), indent=4)
+        if args.output == "-":
+            print(output)
+        else:
+            with open(args.output, "w") as f:
+                f.write(output)
+    elif args.command == "proof":
+        print(json.dumps(open_ledger(args.ledger).proof(args.image_hash), indent=4))
+
+if __name__ == "__main__":
+    main()
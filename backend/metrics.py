@@ -0,0 +1,157 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Prometheus text exposition without a client library: observations are a
+# bisect and a few additions under a lock, and gauges are read only when
+# /metrics is scraped, so instrumentation can stay on in production.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Stage latency buckets in seconds, from 1 ms up to two minutes of inference
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# ---------- METRIC TYPES ----------
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per label combination."""
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # Per-bucket counts (last slot is +Inf), sum, count
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Observes the duration of the with-block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(counts), total, count)
+                      for labels, (counts, total, count) in sorted(self._series.items())]
+        for labelvalues, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ("le",), labelvalues + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Gauge:
+    """
+    A value read when the metrics are rendered. read() returns a number, or
+    a {labelvalue(s): number} dict when the gauge has labels.
+    """
+
+    def __init__(self, name, help_text, read, labelnames=(), kind="gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception as e:
+            print(f"Error reading metric {self.name}: {str(e)}")
+            return []
+        if value is None:
+            return []
+
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        if not self.labelnames:
+            lines.append(f"{self.name} {_format_value(value)}")
+            return lines
+        for labelvalues, sample in sorted(value.items()):
+            if not isinstance(labelvalues, tuple):
+                labelvalues = (labelvalues,)
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(sample)}")
+        return lines
+
+class InFlight:
+    """Thread-safe counter of requests currently being served."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self):
+        with self._lock:
+            self.value += 1
+
+    def dec(self):
+        with self._lock:
+            self.value -= 1
+
+# ---------- REGISTRY ----------
+
+_metrics = []
+
+def register(metric):
+    _metrics.append(metric)
+    return metric
+
+def gauge(name, help_text, labelnames=(), kind="gauge"):
+    """Decorator registering a function as the reader of a gauge."""
+    def decorator(read):
+        register(Gauge(name, help_text, read, labelnames, kind))
+        return read
+    return decorator
+
+def render():
+    """All registered metrics in Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# Duration of every instrumented stage of generation, securing and verification
+STAGE_SECONDS = register(Histogram(
+    "markai_stage_duration_seconds",
+    "Time spent in each stage of the generation, security and verification pipelines.",
+    labelnames=("pipeline", "stage")
+))
+
+def stage_timer(pipeline, stage):
+    """with stage_timer("secure", "png_encode"): ... records one observation."""
+    return STAGE_SECONDS.time(pipeline, stage)
@@ -0,0 +1,65 @@
+import threading
+from collections import OrderedDict
+
+# ---------- PROMPT EMBEDDING CACHE ----------
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of CLIP text-encoder outputs keyed by the final prompt string.
+    The constant negative prompt is encoded once, when the cache is created.
+    Cached tensors are passed to the pipeline as prompt_embeds /
+    negative_prompt_embeds so repeated prompts skip the text encoder.
+    """
+
+    def __init__(self, pipeline, negative_prompt, max_size=256):
+        self.pipeline = pipeline
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_embeds = self._encode(negative_prompt)
+
+    def _encode(self, prompt):
+        import torch
+        with torch.no_grad():
+            prompt_embeds, _ = self.pipeline.encode_prompt(
+                prompt,
+                device=self.pipeline._execution_device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False
+            )
+        return prompt_embeds
+
+    def get(self, prompt):
+        """Returns the (1, tokens, dim) embedding of prompt, encoding it on a miss."""
+        with self._lock:
+            if prompt in self._cache:
+                self._cache.move_to_end(prompt)
+                self.hits += 1
+                return self._cache[prompt]
+            self.misses += 1
+
+        embeds = self._encode(prompt)
+        with self._lock:
+            self._cache[prompt] = embeds
+            self._cache.move_to_end(prompt)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return embeds
+
+    def batch(self, prompts):
+        """Returns (prompt_embeds, negative_prompt_embeds) for a list of prompts."""
+        import torch
+        prompt_embeds = torch.cat([self.get(prompt) for prompt in prompts])
+        negative_embeds = self.negative_embeds.repeat(len(prompts), 1, 1)
+        return prompt_embeds, negative_embeds
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._cache),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
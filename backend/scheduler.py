@@ -0,0 +1,190 @@
+import time
+import queue
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+
+# ---------- DYNAMIC MICRO-BATCHING ----------
+
+class MicroBatchScheduler:
+    """
+    Queues single-image requests and groups those sharing a key
+    (width, height, steps, guidance) into one call of run_batch(key, items).
+    A group is dispatched once it reaches max_batch_size or its oldest request
+    has waited max_wait seconds. A single worker thread owns the model, so
+    concurrent HTTP requests never call the pipeline at the same time.
+
+    With a postprocess pool, each result is handed to postprocess(item, result)
+    on the pool instead of being returned directly, and the caller's future
+    gets its return value. The worker thread moves on to the next batch as
+    soon as the results are queued.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait=0.02, name="scheduler",
+                 postprocess=None, pool=None):
+        self.run_batch = run_batch
+        self.postprocess = postprocess
+        self.pool = pool
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._batch_sizes = Counter()
+        self._batches = 0
+        self._items = 0
+        self._failed_batches = 0
+        self._running = 0
+        self._thread = threading.Thread(target=self._worker, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, key, item):
+        """Queues item under key and returns a Future for its result."""
+        future = Future()
+        with self._cond:
+            self._pending.setdefault(key, deque()).append((time.monotonic(), item, future))
+            self._cond.notify()
+        return future
+
+    def _next_batch(self):
+        """Blocks until a batch is ready; returns (key, [(item, future), ...])."""
+        with self._cond:
+            while True:
+                while not self._pending:
+                    self._cond.wait()
+
+                # Serve the group whose oldest request has waited longest
+                key = min(self._pending, key=lambda k: self._pending[k][0][0])
+                queue = self._pending[key]
+                deadline = queue[0][0] + self.max_wait
+                remaining = deadline - time.monotonic()
+                if len(queue) < self.max_batch_size and remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+
+                batch = []
+                while queue and len(batch) < self.max_batch_size:
+                    _, item, future = queue.popleft()
+                    # Skip requests whose caller cancelled while queued
+                    if future.set_running_or_notify_cancel():
+                        batch.append((item, future))
+                if not queue:
+                    del self._pending[key]
+                if batch:
+                    self._running = len(batch)
+                    return key, batch
+
+    def _worker(self):
+        while True:
+            key, batch = self._next_batch()
+            try:
+                results = self.run_batch(key, [item for item, _ in batch])
+            except Exception as e:
+                self._failed_batches += 1
+                for _, future in batch:
+                    future.set_exception(e)
+                results = None
+            finally:
+                with self._cond:
+                    self._running = 0
+                    self._batches += 1
+                    self._items += len(batch)
+                    self._batch_sizes[len(batch)] += 1
+
+            if results is not None:
+                self._hand_off(batch, results)
+
+    def _hand_off(self, batch, results):
+        """Resolves the batch's futures, through the postprocess pool if there is one."""
+        for (item, future), result in zip(batch, results):
+            if self.pool is None:
+                future.set_result(result)
+            else:
+                # Blocks while the pool's queue is full, which holds back the next batch
+                self.pool.submit_to(future, self.postprocess, item, result)
+
+    def queue_depth(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._pending.values())
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queue_depth": sum(len(queue) for queue in self._pending.values()),
+                "in_progress": self._running,
+                "batches": self._batches,
+                "items": self._items,
+                "failed_batches": self._failed_batches,
+                "mean_batch_size": self._items / self._batches if self._batches else 0.0,
+                "batch_sizes": dict(sorted(self._batch_sizes.items())),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+# ---------- BOUNDED WORKER POOL ----------
+
+class WorkerPool:
+    """
+    Fixed set of worker threads fed through a bounded queue. submit blocks
+    while the queue is full, so a fast producer is slowed to the pace of the
+    workers instead of piling up results in memory.
+    """
+
+    def __init__(self, num_workers=2, max_queue=4, name="worker-pool"):
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._blocked_seconds = 0.0
+        for index in range(num_workers):
+            threading.Thread(target=self._worker, name=f"{name}-{index}", daemon=True).start()
+
+    def submit(self, func, *args):
+        """Queues func(*args) and returns a Future for its result."""
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.submit_to(future, func, *args)
+        return future
+
+    def submit_to(self, future, func, *args):
+        """Queues func(*args); its result or exception is set on future."""
+        started = time.monotonic()
+        self._queue.put((future, func, args))
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            with self._lock:
+                self._blocked_seconds += waited
+
+    def _worker(self):
+        while True:
+            future, func, args = self._queue.get()
+            with self._lock:
+                self._running += 1
+            try:
+                future.set_result(func(*args))
+                failed = False
+            except Exception as e:
+                future.set_exception(e)
+                failed = True
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                    self._failed += failed
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "in_progress": self._running,
+                "completed": self._completed,
+                "failed": self._failed,
+                "workers": self.num_workers,
+                "max_queue": self.max_queue,
+                "producer_blocked_seconds": round(self._blocked_seconds, 3),
+            }
@@ -0,0 +1,146 @@
+import os
+import threading
+from itertools import combinations
+import numpy as np
+from PIL import Image
+from watermark import dct_matrix
+from connections import after_fork, thread_local_connection
+
+# Perceptual hashes of generated images, used to find ledger records for
+# copies whose metadata was stripped by a re-encode or screenshot
+PHASH_INDEX_PATH = os.environ.get("PHASH_INDEX_PATH", "phash_index.db")
+
+# Largest Hamming distance (out of 64 bits) still reported as a match
+PHASH_MAX_DISTANCE = int(os.environ.get("PHASH_MAX_DISTANCE", 10))
+
+# ---------- PERCEPTUAL HASH ----------
+
+PHASH_SIZE = 32
+PHASH_BITS = 8
+_PHASH_DCT = dct_matrix(PHASH_SIZE)
+
+def perceptual_hash(image):
+    """
+    64-bit DCT perceptual hash: the signs of the lowest 8x8 frequencies of
+    the 32x32 grayscale image relative to their median.
+    """
+    gray = np.asarray(image.convert("L").resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (_PHASH_DCT @ gray @ _PHASH_DCT.T)[:PHASH_BITS, :PHASH_BITS].reshape(-1)
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+# ---------- MULTI-INDEX HASHING ----------
+
+class PerceptualHashIndex:
+    """
+    Multi-index hashing over 64-bit perceptual hashes. Each hash is split into
+    PHASH_CHUNKS 16-bit chunks with one exact-match table per chunk; any hash
+    within distance r shares at least one chunk within r // PHASH_CHUNKS bits,
+    so a search probes a few hundred buckets instead of scanning every entry.
+    Entries persist in SQLite and are loaded incrementally like LedgerIndex.
+    """
+
+    CHUNKS = 4
+    CHUNK_BITS = 16
+
+    def __init__(self, path=PHASH_INDEX_PATH):
+        self.path = path
+        self._connect = thread_local_connection(path, self._create_schema)
+        self._lock = threading.Lock()
+        self._entries = []
+        self._tables = [{} for _ in range(self.CHUNKS)]
+        self._cursor = 0
+        self._connect()
+
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS phashes ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "phash TEXT NOT NULL, "
+            "image_hash TEXT NOT NULL, "
+            "image_id TEXT)"
+        )
+
+    def _chunks(self, phash):
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(phash >> (i * self.CHUNK_BITS)) & mask for i in range(self.CHUNKS)]
+
+    def _index_entry(self, phash, image_hash, image_id):
+        position = len(self._entries)
+        self._entries.append((phash, image_hash, image_id))
+        for table, chunk in zip(self._tables, self._chunks(phash)):
+            table.setdefault(chunk, []).append(position)
+
+    def refresh(self):
+        """Loads entries written since the last refresh (by any process)."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT seq, phash, image_hash, image_id FROM phashes WHERE seq > ? ORDER BY seq",
+                (self._cursor,)
+            ).fetchall()
+            for seq, phash, image_hash, image_id in rows:
+                self._index_entry(int(phash, 16), image_hash, image_id)
+                self._cursor = seq
+
+    def add(self, phash, image_hash, image_id=None):
+        """Records the perceptual hash of a generated image."""
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO phashes (phash, image_hash, image_id) VALUES (?, ?, ?)",
+                (f"{phash:016x}", image_hash, image_id)
+            )
+
+    def _probes(self, chunk, radius):
+        """Every chunk value within radius bits of chunk."""
+        yield chunk
+        for flips in range(1, radius + 1):
+            for bits in combinations(range(self.CHUNK_BITS), flips):
+                value = chunk
+                for bit in bits:
+                    value ^= 1 << bit
+                yield value
+
+    def search(self, phash, max_distance=PHASH_MAX_DISTANCE, limit=5):
+        """Returns up to limit entries within max_distance, nearest first."""
+        self.refresh()
+        radius = max_distance // self.CHUNKS
+        candidates = set()
+        for table, chunk in zip(self._tables, self._chunks(phash)):
+            for probe in self._probes(chunk, radius):
+                candidates.update(table.get(probe, ()))
+
+        matches = []
+        for position in candidates:
+            entry_phash, image_hash, image_id = self._entries[position]
+            distance = hamming_distance(phash, entry_phash)
+            if distance <= max_distance:
+                matches.append({"image_hash": image_hash, "image_id": image_id, "distance": distance})
+        matches.sort(key=lambda match: match["distance"])
+        return matches[:limit]
+
+    def __len__(self):
+        return len(self._entries)
+
+_index = None
+_index_lock = threading.Lock()
+
+def open_phash_index(path=PHASH_INDEX_PATH):
+    """Returns the shared perceptual hash index."""
+    global _index
+    with _index_lock:
+        if _index is None or _index.path != path:
+            _index = PerceptualHashIndex(path)
+        return _index
+
+@after_fork
+def _reset_after_fork():
+    """Forked workers keep the loaded index (connections are reset by connections.py)."""
+    global _index_lock
+    _index_lock = threading.Lock()
+    if _index is not None:
+        _index._lock = threading.Lock()
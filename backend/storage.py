@@ -0,0 +1,280 @@
+import os
+import time
+import shutil
+import hashlib
+import calendar
+import threading
+from connections import thread_local_connection
+
+# ---------- TIME-BUCKETED FILE STORE ----------
+#
+# Files are written to <root>/<bucket>/<filename>, where the bucket is the UTC
+# start of the bucket_seconds interval the file was written in (e.g.
+# 20261018-1400). Expiry and quota eviction drop whole buckets, oldest first,
+# so their cost depends on what is removed, not on how many files are kept.
+# Byte usage is tracked in memory as files are written. With a usage table
+# the per-bucket counts are also persisted, and opening the store only lists
+# the bucket directories; without one (or for buckets the table does not
+# know) the files are walked once, when the store is opened.
+
+BUCKET_FORMAT = "%Y%m%d-%H%M"
+
+class BucketedStore:
+    """
+    A directory of time-bucketed shards with optional byte quota.
+    quota_bytes <= 0 means unlimited. Usage is tracked per process, so each
+    server process enforces the quota on the files it knows about.
+    """
+
+    def __init__(self, root, bucket_seconds=3600, quota_bytes=0, on_drop=None, usage=None):
+        self.root = root
+        self.on_drop = on_drop
+        self.usage_table = usage
+        self.bucket_seconds = max(60, int(bucket_seconds))
+        self.quota_bytes = quota_bytes
+        self._lock = threading.Lock()
+        self._buckets = {}  # bucket name -> [bytes, files], kept in name (= time) order
+        self._writing = {}  # bucket name -> writes in progress
+        self.evicted_buckets = 0
+        self.evicted_bytes = 0
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    def _bucket_name(self, timestamp):
+        start = int(timestamp) // self.bucket_seconds * self.bucket_seconds
+        return time.strftime(BUCKET_FORMAT, time.gmtime(start))
+
+    def _bucket_start(self, name):
+        try:
+            return calendar.timegm(time.strptime(name, BUCKET_FORMAT))
+        except ValueError:
+            return None
+
+    def _scan(self):
+        """Builds the usage table from the buckets already on disk."""
+        saved = self.usage_table.load_usage() if self.usage_table else {}
+        stale = set(saved)
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or self._bucket_start(entry.name) is None:
+                continue
+            stale.discard(entry.name)
+            if entry.name in saved:
+                self._buckets[entry.name] = list(saved[entry.name])
+                continue
+            # Only buckets the usage table does not know are walked
+            usage = [0, 0]
+            for file in os.scandir(entry.path):
+                if file.is_file():
+                    usage[0] += file.stat().st_size
+                    usage[1] += 1
+            self._buckets[entry.name] = usage
+            if self.usage_table:
+                self.usage_table.add_usage(entry.name, *usage)
+        if stale:
+            self.usage_table.forget_usage(stale)
+        self._buckets = dict(sorted(self._buckets.items()))
+
+    def write(self, filename, data):
+        """
+        Writes data to the current bucket and enforces the quota.
+        Returns the path relative to root ("<bucket>/<filename>").
+        """
+        with self._lock:
+            bucket = self._bucket_name(time.time())
+            if bucket not in self._buckets:
+                os.makedirs(os.path.join(self.root, bucket), exist_ok=True)
+                self._buckets[bucket] = [0, 0]
+                self._buckets = dict(sorted(self._buckets.items()))
+            self._writing[bucket] = self._writing.get(bucket, 0) + 1
+
+        path = os.path.join(self.root, bucket, filename)
+        try:
+            with open(path, "wb") as f:
+                f.write(data)
+        finally:
+            with self._lock:
+                self._writing[bucket] -= 1
+                if not self._writing[bucket]:
+                    del self._writing[bucket]
+
+        with self._lock:
+            if bucket in self._buckets:
+                self._buckets[bucket][0] += len(data)
+                self._buckets[bucket][1] += 1
+        if self.usage_table:
+            self.usage_table.add_usage(bucket, len(data), 1)
+        self.enforce_quota()
+        return f"{bucket}/{filename}"
+
+    def _drop(self, buckets):
+        """Deletes buckets already removed from the in-memory usage."""
+        if buckets and self.usage_table:
+            try:
+                self.usage_table.forget_usage(buckets)
+            except Exception as e:
+                print(f"Error forgetting usage of {self.root}: {str(e)}")
+        if buckets and self.on_drop:
+            try:
+                self.on_drop(buckets)
+            except Exception as e:
+                print(f"Error forgetting buckets of {self.root}: {str(e)}")
+        for bucket in buckets:
+            try:
+                shutil.rmtree(os.path.join(self.root, bucket))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Error removing {os.path.join(self.root, bucket)}: {str(e)}")
+
+    def enforce_quota(self):
+        """Evicts the oldest buckets until usage fits the quota; the newest is always kept."""
+        if self.quota_bytes <= 0:
+            return 0
+        evicted = []
+        with self._lock:
+            total = sum(usage[0] for usage in self._buckets.values())
+            for bucket in list(self._buckets)[:-1]:
+                if total <= self.quota_bytes:
+                    break
+                if bucket in self._writing:
+                    continue
+                size = self._buckets.pop(bucket)[0]
+                total -= size
+                self.evicted_buckets += 1
+                self.evicted_bytes += size
+                evicted.append(bucket)
+        self._drop(evicted)
+        return len(evicted)
+
+    def expire(self, max_age_seconds):
+        """Deletes every bucket that ended more than max_age_seconds ago."""
+        cutoff = time.time() - max_age_seconds
+        expired = []
+        with self._lock:
+            for bucket in list(self._buckets):
+                start = self._bucket_start(bucket)
+                if start is None or start + self.bucket_seconds > cutoff:
+                    break
+                if bucket not in self._writing:
+                    del self._buckets[bucket]
+                    expired.append(bucket)
+        self._drop(expired)
+        self._expire_unbucketed(cutoff)
+        return len(expired)
+
+    def _expire_unbucketed(self, cutoff):
+        """Removes old files left at the top level by the flat layout of earlier versions."""
+        for entry in os.scandir(self.root):
+            try:
+                if entry.is_file() and entry.stat().st_ctime < cutoff:
+                    os.remove(entry.path)
+            except Exception as e:
+                print(f"Error cleaning up {entry.path}: {str(e)}")
+
+    def usage(self):
+        with self._lock:
+            return {
+                "bytes": sum(usage[0] for usage in self._buckets.values()),
+                "files": sum(usage[1] for usage in self._buckets.values()),
+                "buckets": len(self._buckets),
+                "quota_bytes": self.quota_bytes,
+                "evicted_buckets": self.evicted_buckets,
+                "evicted_bytes": self.evicted_bytes,
+            }
+
+# ---------- CONTENT-ADDRESSED IMAGES ----------
+
+# ImageID -> stored file catalogue, so generated images can be fetched again
+IMAGE_CATALOG_PATH = os.environ.get("IMAGE_CATALOG_PATH", "image_catalog.db")
+
+class ImageStore:
+    """
+    Content-addressed image files on top of a BucketedStore.
+    Files are named by the SHA-256 of their bytes, which doubles as their
+    ETag; a SQLite catalogue maps each ImageID to its file and keeps
+    the per-bucket usage counts. Catalogue rows of evicted or expired
+    buckets are dropped together with the files.
+    """
+
+    def __init__(self, root, bucket_seconds=3600, quota_bytes=0, catalog_path=IMAGE_CATALOG_PATH):
+        self.catalog_path = catalog_path
+        self._connect = thread_local_connection(catalog_path, self._create_schema)
+        self._connect()
+        self.files = BucketedStore(root, bucket_seconds, quota_bytes, on_drop=self._forget_buckets, usage=self)
+        self.root = self.files.root
+
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "image_id TEXT PRIMARY KEY, "
+            "digest TEXT NOT NULL, "
+            "bucket TEXT NOT NULL, "
+            "size INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS images_bucket ON images (bucket)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS bucket_usage ("
+            "bucket TEXT PRIMARY KEY, "
+            "bytes INTEGER NOT NULL, "
+            "files INTEGER NOT NULL)"
+        )
+
+    def put(self, image_id, data):
+        """
+        Stores data for image_id in the current bucket. Every secured PNG embeds
+        its own ImageID, so outputs are never byte-identical and are not shared.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        bucket = self.files.write(f"{digest}.png", data).split("/", 1)[0]
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO images (image_id, digest, bucket, size) VALUES (?, ?, ?, ?)",
+                (image_id, digest, bucket, len(data))
+            )
+        return digest
+
+    def locate(self, image_id):
+        """Returns (path, digest, size) of a stored image, or None."""
+        row = self._connect().execute(
+            "SELECT digest, bucket, size FROM images WHERE image_id = ?", (image_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        digest, bucket, size = row
+        path = os.path.abspath(os.path.join(self.root, bucket, f"{digest}.png"))
+        return (path, digest, size) if os.path.exists(path) else None
+
+    # Usage table of the BucketedStore: bucket -> (bytes, files), updated as
+    # files are written so opening the store never has to stat every file
+
+    def load_usage(self):
+        rows = self._connect().execute("SELECT bucket, bytes, files FROM bucket_usage")
+        return {bucket: (size, files) for bucket, size, files in rows}
+
+    def add_usage(self, bucket, size, files):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO bucket_usage (bucket, bytes, files) VALUES (?, ?, ?) "
+                "ON CONFLICT(bucket) DO UPDATE SET bytes = bytes + excluded.bytes, files = files + excluded.files",
+                (bucket, size, files)
+            )
+
+    def forget_usage(self, buckets):
+        conn = self._connect()
+        with conn:
+            conn.executemany("DELETE FROM bucket_usage WHERE bucket = ?", ((bucket,) for bucket in buckets))
+
+    def _forget_buckets(self, buckets):
+        conn = self._connect()
+        with conn:
+            conn.executemany("DELETE FROM images WHERE bucket = ?", ((bucket,) for bucket in buckets))
+
+    def expire(self, max_age_seconds):
+        return self.files.expire(max_age_seconds)
+
+    def usage(self):
+        return self.files.usage()
@@ -0,0 +1,306 @@
+import io
+import json
+import zlib
+import struct
+import hashlib
+import multiprocessing
+from PIL import Image
+from watermark import lsb_reveal, dct_detect, pack_watermark, MODEL_CODES
+from ledger import LEDGER_PATH, open_ledger, open_ledger_index
+from similarity import perceptual_hash, open_phash_index
+from metrics import stage_timer
+
+# Verification needs only PIL, NumPy and the ledger, so this module never
+# imports torch or diffusers and is safe to load in worker processes.
+
+class InvalidImageError(ValueError):
+    """Raised when uploaded bytes cannot be decoded as an image."""
+
+def verify_pool_context():
+    """
+    Multiprocessing context for verification workers. Workers start from a
+    fresh interpreter rather than a fork of the caller, whose other threads
+    (metrics, ledger committer, ...) may hold locks mid-fork. With forkserver
+    they are forked from a clean process that has already imported this
+    module; elsewhere (Windows) they are spawned.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["verification"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+# ---------- WATERMARK EXTRACTION ----------
+
+def extract_watermark(image):
+    """Extracts the hidden watermark from an image or an image path."""
+    try:
+        if not isinstance(image, Image.Image):
+            with Image.open(image) as opened:
+                return lsb_reveal(opened)
+        return lsb_reveal(image)
+    except Exception as e:
+        # Handle extraction errors gracefully
+        print(f"Watermark extraction error: {str(e)}")
+        return None
+
+def detect_frequency_watermark(image):
+    """Returns (found, score) for the block-DCT spread-spectrum watermark."""
+    try:
+        return dct_detect(image)
+    except Exception as e:
+        print(f"Frequency watermark detection error: {str(e)}")
+        return False, 0.0
+
+# ---------- METADATA HASHING ----------
+
+def compute_metadata_hash(metadata_dict):
+    """
+    Converts metadata dict to sorted JSON, hashes it with SHA-256.
+    This ensures even tiny changes to metadata will result in a different hash.
+    """
+    metadata_json = json.dumps(metadata_dict, sort_keys=True)
+    return hashlib.sha256(metadata_json.encode()).hexdigest()
+
+def read_image_metadata(image):
+    """Reads the PNG text metadata from an already decoded image."""
+    metadata = {}
+    if image.format != "PNG":
+        return metadata
+    if hasattr(image, 'text'):
+        metadata.update(image.text)
+    if hasattr(image, 'info'):
+        metadata.update(image.info)
+    return metadata
+
+def watermark_text_for(metadata):
+    """The LSB watermark message embedded alongside the given metadata."""
+    return f"{metadata['GeneratedBy']} {metadata['ImageID']} - {metadata['GenerationDate']}"
+
+def watermark_payload_for(metadata):
+    """
+    The packed binary LSB payload for the given metadata; it reveals as
+    watermark_text_for(metadata). Models without a payload code fall back
+    to the text format.
+    """
+    if metadata["GeneratedBy"] not in MODEL_CODES:
+        return watermark_text_for(metadata)
+    return pack_watermark(metadata["ImageID"], metadata["GenerationDate"], metadata["GeneratedBy"])
+
+# ---------- PNG CHUNK READER ----------
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def read_png_text(data):
+    """
+    Returns the tEXt/zTXt/iTXt entries of PNG bytes without inflating the
+    image data (IDAT chunks are skipped by their length). Returns None if
+    data is not a well-formed PNG.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return None
+    text = {}
+    offset = len(PNG_SIGNATURE)
+    try:
+        while offset + 8 <= len(data):
+            length, chunk_type = struct.unpack_from(">I4s", data, offset)
+            start = offset + 8
+            end = start + length
+            if end + 4 > len(data):
+                return None
+            if chunk_type == b"IEND":
+                return text
+            if chunk_type == b"tEXt":
+                key, _, value = data[start:end].partition(b"\0")
+                text[key.decode("latin-1")] = value.decode("latin-1")
+            elif chunk_type == b"zTXt":
+                key, _, value = data[start:end].partition(b"\0")
+                text[key.decode("latin-1")] = zlib.decompress(value[1:]).decode("latin-1")
+            elif chunk_type == b"iTXt":
+                key, _, rest = data[start:end].partition(b"\0")
+                compressed, rest = rest[0], rest[2:]
+                _, _, rest = rest.partition(b"\0")  # language tag
+                _, _, value = rest.partition(b"\0")  # translated keyword
+                text[key.decode("latin-1")] = (zlib.decompress(value) if compressed else value).decode("utf-8")
+            offset = end + 4  # skip the CRC
+    except (struct.error, zlib.error, UnicodeDecodeError, IndexError):
+        return None
+    return None
+
+# ---------- SIMILARITY SEARCH ----------
+
+def find_similar_images(image, ledger_path=LEDGER_PATH):
+    """
+    Returns the nearest generated images by perceptual hash, so a copy whose
+    metadata was stripped can still be linked to its ledger record.
+    """
+    try:
+        with stage_timer("verify", "similarity_search"):
+            matches = open_phash_index().search(perceptual_hash(image))
+    except Exception as e:
+        print(f"Similarity search error: {str(e)}")
+        return []
+
+    ledger_index = open_ledger_index(ledger_path)
+    for match in matches:
+        match["on_blockchain"], match["timestamp"] = ledger_index.lookup(match["image_hash"])
+    return matches
+
+# ---------- VERIFICATION ----------
+
+def decode_image(data):
+    """Decodes image bytes once, in memory."""
+    try:
+        with stage_timer("verify", "decode"):
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        return image
+    except Exception as e:
+        raise InvalidImageError(f"Invalid image file: {str(e)}")
+
+def verify_image_object(image, ledger_path=LEDGER_PATH):
+    """
+    Checks a decoded image against the security measures and returns
+    the "verification" object served by /verify.
+    """
+    with stage_timer("verify", "total"):
+        return _verify_image_object(image, ledger_path)
+
+def _verify_image_object(image, ledger_path):
+    # Extract watermark
+    try:
+        with stage_timer("verify", "lsb_extract"):
+            watermark = extract_watermark(image)
+        watermark_found = watermark is not None
+    except Exception as e:
+        watermark = None
+        watermark_found = False
+        print(f"Watermark extraction error: {str(e)}")
+
+    # The frequency watermark survives re-encoding that destroys the LSB one
+    with stage_timer("verify", "frequency_detect"):
+        frequency_found, frequency_score = detect_frequency_watermark(image)
+
+    # Get metadata from png text chunks; other formats carry none of ours
+    metadata = read_image_metadata(image)
+
+    # Remove hash for computing new hash
+    stored_hash = metadata.get("TamperCheckHash")
+    hash_found = stored_hash is not None
+
+    if hash_found:
+        # Verify hash
+        with stage_timer("verify", "metadata_hash"):
+            temp_metadata = {k: v for k, v in metadata.items() if k != "TamperCheckHash"}
+            recomputed_hash = compute_metadata_hash(temp_metadata)
+            hash_valid = stored_hash == recomputed_hash
+
+        # Check in ledger
+        with stage_timer("verify", "ledger_lookup"):
+            on_blockchain = stored_hash in open_ledger_index(ledger_path)
+    else:
+        hash_valid = False
+        on_blockchain = False
+
+    # Nearest generated images, found even when the metadata is gone
+    similar_images = find_similar_images(image, ledger_path)
+
+    # Determine if this is an AI-generated image
+    # Only consider it AI-generated if it has EITHER a watermark OR valid metadata
+    is_ai_generated = watermark_found or frequency_found or hash_found
+
+    # Create a clear message for the user
+    if is_ai_generated:
+        image_type = "AI-generated image"
+        confidence = 100 if (watermark_found and hash_valid and on_blockchain) else 85
+        if watermark_found and hash_valid and on_blockchain:
+            authenticity = "Verified authentic AI-generated image"
+        else:
+            authenticity = "AI-generated image with potential tampering"
+    else:
+        image_type = "Not an AI-generated image"
+        authenticity = "This appears to be a regular image, not generated by this system"
+        confidence = 0  # 0% confidence it's AI-generated
+
+    return {
+        "image_type": image_type,
+        "authenticity": authenticity,
+        "confidence": confidence,
+        "watermark_found": watermark_found,
+        "watermark_content": watermark if watermark_found else None,
+        "frequency_watermark_found": frequency_found,
+        "frequency_watermark_score": round(frequency_score, 2),
+        "metadata_hash_found": hash_found,
+        "metadata_valid": hash_valid,
+        "on_blockchain": on_blockchain,
+        "is_authentic": watermark_found and hash_valid and on_blockchain,
+        "is_ai_generated": is_ai_generated,
+        "similar_images": similar_images,
+        "metadata": {k: v for k, v in metadata.items() if k != "TamperCheckHash"}
+    }
+
+def verify_png_fast(data, ledger_path=LEDGER_PATH):
+    """
+    Verifies unmodified MarkAI output from its PNG text chunks alone.
+    The metadata hash is checked first, then the ledger record, whose
+    content digest must equal the SHA-256 of data: only then are the
+    pixels known to be exactly the secured ones. Returns the verification
+    object, or None when the image needs the full pixel-level check.
+    """
+    with stage_timer("verify", "fast_path"):
+        metadata = read_png_text(data)
+        stored_hash = metadata.get("TamperCheckHash") if metadata else None
+        if stored_hash is None:
+            return None
+        metadata = {k: v for k, v in metadata.items() if k != "TamperCheckHash"}
+        if compute_metadata_hash(metadata) != stored_hash:
+            return None
+
+        record = open_ledger(ledger_path).get(stored_hash)
+        if not isinstance(record, dict) or record.get("content_sha256") != hashlib.sha256(data).hexdigest():
+            return None
+
+    # The bytes are exactly what the pipeline produced, so both watermarks are present
+    return {
+        "image_type": "AI-generated image",
+        "authenticity": "Verified authentic AI-generated image",
+        "confidence": 100,
+        "watermark_found": True,
+        "watermark_content": watermark_text_for(metadata),
+        "frequency_watermark_found": True,
+        "frequency_watermark_score": None,
+        "metadata_hash_found": True,
+        "metadata_valid": True,
+        "on_blockchain": True,
+        "is_authentic": True,
+        "is_ai_generated": True,
+        "similar_images": [{
+            "image_hash": stored_hash,
+            "image_id": metadata.get("ImageID"),
+            "distance": 0,
+            "on_blockchain": True,
+            "timestamp": record.get("timestamp")
+        }],
+        "metadata": metadata,
+        "verified_from": "metadata"
+    }
+
+def verify_image_bytes(data, ledger_path=LEDGER_PATH):
+    """
+    Verifies uploaded bytes, from the PNG text chunks when they prove the
+    image unmodified, else by decoding the pixels.
+    Raises InvalidImageError if the bytes cannot be decoded.
+    """
+    result = verify_png_fast(data, ledger_path)
+    if result is not None:
+        return result
+    return {**verify_image_object(decode_image(data), ledger_path), "verified_from": "pixels"}
+
+def verify_batch_item(index, filename, data, ledger_path=LEDGER_PATH):
+    """Verifies one image of a batch; runs inside a worker process."""
+    try:
+        return {"index": index, "filename": filename, "verification": verify_image_bytes(data, ledger_path)}
+    except InvalidImageError as e:
+        return {"index": index, "filename": filename, "error": str(e)}
+    except Exception as e:
+        return {"index": index, "filename": filename, "error": f"Error verifying image: {str(e)}"}
@@ -0,0 +1,93 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# ---------- VERIFICATION RESULT CACHE ----------
+
+class VerificationCache:
+    """
+    LRU cache of /verify results keyed by the SHA-256 of the uploaded bytes,
+    with entries expiring after ttl seconds. The ledger is append-only, so a
+    result only goes stale when a hash it found missing is recorded later;
+    each entry keeps those hashes and is dropped once any of them appears.
+    """
+
+    def __init__(self, max_size=4096, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def key(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, key, is_recorded):
+        """
+        Returns the cached result for key, or None. is_recorded(hash) tells
+        whether a hash the result depends on has since entered the ledger.
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            result, missing, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._cache[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+
+        # Looked up outside the lock: a ledger refresh may touch the store
+        if any(is_recorded(image_hash) for image_hash in missing):
+            with self._lock:
+                self._cache.pop(key, None)
+                self.invalidated += 1
+                self.misses += 1
+            return None
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+            self.hits += 1
+        return result
+
+    def put(self, key, result, missing=()):
+        """Caches result; missing lists the ledger hashes it found absent."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = (result, tuple(missing), time.monotonic())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._cache),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "invalidated": self.invalidated,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+def missing_ledger_hashes(result, stored_hash):
+    """The ledger hashes a verification result found missing."""
+    missing = []
+    if stored_hash and not result.get("on_blockchain"):
+        missing.append(stored_hash)
+    for match in result.get("similar_images") or ():
+        if not match.get("on_blockchain"):
+            missing.append(match["image_hash"])
+    return missing
@@ -1,28 +1,30 @@
 import os
+import io
+import sys
 import json
-import hashlib
+import time
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
-from stegano import lsb
+from watermark import lsb_reveal, dct_detect
+from verification import compute_metadata_hash, verify_png_fast, verify_pool_context
+from ledger import LEDGER_PATH, open_ledger, open_ledger_index, verify_inclusion, verify_root_chain
 import argparse
 
-# Path for the blockchain ledger
-LEDGER_PATH = "image_ledger.json"
+# Bulk audits remember (path, size, mtime, result) here, so re-runs only verify new or changed files
+AUDIT_MANIFEST_PATH = os.environ.get("AUDIT_MANIFEST_PATH", "audit_manifest.db")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tif", ".tiff")
 
-def compute_metadata_hash(metadata_dict):
-    """
-    Converts metadata dict to sorted JSON, hashes it with SHA-256.
-    This ensures even tiny changes to metadata will result in a different hash.
-    """
-    metadata_json = json.dumps(metadata_dict, sort_keys=True)
-    return hashlib.sha256(metadata_json.encode()).hexdigest()
-
-def verify_image_security(image_path):
+def verify_image_security(image_path, roots=None, proof=None):
     """    
     Verifies security pipelines in the image:
     1. Steganographic watermark
     2. Metadata integrity
     3. Blockchain ledger verification
     
+    With roots (the exported batch roots) the ledger check uses the image's
+    inclusion proof instead of the local ledger, which is then not needed.
+    
     Returns a dict with verification results.
     If any of these security measures is present, it's considered an AI-generated image.
     """
@@ -33,6 +35,10 @@ def verify_image_security(image_path):
             "found": False,
             "content": None
         },
+        "frequency_watermark": {
+            "found": False,
+            "score": None
+        },
         "metadata": {
             "found": False,
             "content": {},
@@ -41,7 +47,8 @@ def verify_image_security(image_path):
         },
         "blockchain": {
             "found": False,
-            "timestamp": None
+            "timestamp": None,
+            "proof_verified": None
         },
         "overall_authenticity": False,
         "is_ai_generated": False
@@ -52,19 +59,51 @@ def verify_image_security(image_path):
         return results
     
     try:
+        with open(image_path, "rb") as f:
+            data = f.read()
+        
+        # Unmodified MarkAI output is verified from its PNG text chunks alone
+        fast = verify_png_fast(data, LEDGER_PATH) if roots is None else None
+        if fast is not None:
+            results["is_valid_image"] = True
+            results["watermark"] = {"found": True, "content": fast["watermark_content"]}
+            results["frequency_watermark"] = {"found": True, "score": None}
+            results["metadata"] = {
+                "found": True,
+                "content": fast["metadata"],
+                "hash_found": True,
+                "hash_valid": True
+            }
+            results["blockchain"] = {
+                "found": True,
+                "timestamp": fast["similar_images"][0]["timestamp"],
+                "proof_verified": None
+            }
+            results["is_ai_generated"] = True
+            results["overall_authenticity"] = True
+            return results
+        
         # Try to open the image
-        image = Image.open(image_path)
+        image = Image.open(io.BytesIO(data))
         results["is_valid_image"] = True
         
         # 1. Try to extract steganographic watermark
         try:
-            watermark = lsb.reveal(image_path)
+            watermark = lsb_reveal(image)
             if watermark:
                 results["watermark"]["found"] = True
                 results["watermark"]["content"] = watermark
         except Exception as e:
             print(f"Watermark extraction error: {e}")
         
+        # 1b. Correlate the frequency-domain watermark (survives re-encoding)
+        try:
+            found, score = dct_detect(image)
+            results["frequency_watermark"]["found"] = found
+            results["frequency_watermark"]["score"] = round(score, 2)
+        except Exception as e:
+            print(f"Frequency watermark detection error: {e}")
+        
         # 2. Extract metadata and verify hash
         metadata = image.info
         
@@ -89,20 +128,22 @@ def verify_image_security(image_path):
                     results["metadata"]["hash_valid"] = True
                     
                     # 3. Check if hash exists in the blockchain ledger
-                    if os.path.exists(LEDGER_PATH):
-                        with open(LEDGER_PATH, "r") as f:
-                            ledger = json.load(f)
-                            
-                        if stored_hash in ledger:
-                            results["blockchain"]["found"] = True
-                            if isinstance(ledger[stored_hash], dict) and "timestamp" in ledger[stored_hash]:
-                                results["blockchain"]["timestamp"] = ledger[stored_hash]["timestamp"]
-                            else:
-                                results["blockchain"]["timestamp"] = "Unknown (legacy format)"
+                    if roots is not None:
+                        found, timestamp = check_inclusion_proof(stored_hash, proof, roots)
+                        results["blockchain"]["proof_verified"] = found
+                    else:
+                        found, timestamp = open_ledger_index(LEDGER_PATH).lookup(stored_hash)
+                    if found:
+                        results["blockchain"]["found"] = True
+                        if timestamp is not None:
+                            results["blockchain"]["timestamp"] = timestamp
+                        else:
+                            results["blockchain"]["timestamp"] = "Unknown (legacy format)"
 
         # Determine if it's an AI-generated image (if any security measure is present)
         results["is_ai_generated"] = (
             results["watermark"]["found"] or 
+            results["frequency_watermark"]["found"] or 
             (results["metadata"]["hash_found"] and results["metadata"]["hash_valid"]) or 
             results["blockchain"]["found"]
         )
@@ -121,6 +162,15 @@ def verify_image_security(image_path):
         print(f"Error during verification: {e}")
         return results
 
+def check_inclusion_proof(stored_hash, proof, roots):
+    """Returns (found, sealed_at) for a hash checked against the batch roots only."""
+    if proof is None or proof.get("image_hash") != stored_hash:
+        return False, None
+    if not verify_root_chain(roots) or not verify_inclusion(proof, roots):
+        return False, None
+    batch = next(b for b in roots if b["batch_id"] == proof["batch_id"])
+    return True, batch["sealed_at"]
+
 def print_verification_results(results):
     """Prints the verification results in a readable format."""
     print("\n===== IMAGE VERIFICATION RESULTS =====")
@@ -158,6 +208,14 @@ def print_verification_results(results):
     else:
         print("   ❌ Not found")
     
+    print("\n   Frequency-domain watermark:")
+    if results["frequency_watermark"]["found"] and results["frequency_watermark"]["score"] is None:
+        print("   ✅ Present (image bytes match the ledger record)")
+    elif results["frequency_watermark"]["found"]:
+        print(f"   ✅ Detected (score: {results['frequency_watermark']['score']})")
+    else:
+        print(f"   ❌ Not detected (score: {results['frequency_watermark']['score']})")
+    
     # 2. Metadata & Hash
     print("\n2. METADATA:")
     if results["metadata"]["found"]:
@@ -180,17 +238,223 @@ def print_verification_results(results):
     
     # 3. Blockchain Ledger
     print("\n3. BLOCKCHAIN LEDGER:")
-    if results["blockchain"]["found"]:
+    if results["blockchain"]["found"] and results["blockchain"]["proof_verified"]:
+        print(f"   ✅ Inclusion proof verified against the batch roots (sealed: {results['blockchain']['timestamp']})")
+    elif results["blockchain"]["found"]:
         print(f"   ✅ Verification record found (timestamp: {results['blockchain']['timestamp']})")
     else:
         print("   ❌ Not found in security ledger")
 
+# ---------- BULK AUDIT ----------
+
+class AuditManifest:
+    """
+    SQLite record of audited files: (path, size, mtime_ns, result).
+    Also keeps the ledger size at the last audit, so results that found a
+    valid hash missing from the ledger are checked again once it has grown.
+    """
+
+    def __init__(self, path=AUDIT_MANIFEST_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, "
+            "result TEXT NOT NULL, "
+            "audited_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.commit()
+
+    def load(self):
+        """Returns {path: (size, mtime_ns, result)}."""
+        return {path: (size, mtime_ns, json.loads(result)) for path, size, mtime_ns, result
+                in self.conn.execute("SELECT path, size, mtime_ns, result FROM files")}
+
+    def put_many(self, records):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, result, audited_at) VALUES (?, ?, ?, ?, ?)",
+                ((r["path"], r["size"], r["mtime_ns"], json.dumps(r["result"]), time.time()) for r in records)
+            )
+
+    def remove(self, paths):
+        with self.conn:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in paths))
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+def find_images(root):
+    """Absolute paths of the image files under root, in a stable order."""
+    if os.path.isfile(root):
+        return [os.path.abspath(root)]
+    paths = []
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        paths.extend(os.path.abspath(os.path.join(directory, name)) for name in sorted(files)
+                     if name.lower().endswith(IMAGE_EXTENSIONS))
+    return paths
+
+def needs_ledger_recheck(result):
+    """True for a result whose intact hash was not yet in the ledger."""
+    return result["metadata"]["hash_valid"] and not result["blockchain"]["found"]
+
+def _init_worker():
+    # Per-file diagnostics go to stderr so they never mix with JSONL on stdout
+    sys.stdout = sys.stderr
+    # Workers start afresh (not forked), and must not create a missing ledger either
+    open_ledger(LEDGER_PATH, create=False)
+
+def audit_file(path):
+    """Verifies one file; runs inside a worker process."""
+    st = os.stat(path)
+    return {"path": path, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+            "result": verify_image_security(path)}
+
+def audit_record(record, cached):
+    result = record["result"]
+    return {
+        "path": record["path"],
+        "size": record["size"],
+        "mtime_ns": record["mtime_ns"],
+        "cached": cached,
+        "is_ai_generated": result["is_ai_generated"],
+        "overall_authenticity": result["overall_authenticity"],
+        "result": result
+    }
+
+def audit_images(roots, output, manifest, workers=None, changed_only=False, flush_every=500):
+    """
+    Verifies every image under roots (directories or files) across a process
+    pool and writes one JSON line per file to output, then a final
+    {"summary": ...} line. Files whose size and mtime match the manifest
+    reuse the stored result. Returns the summary dict.
+    """
+    started = time.perf_counter()
+    paths = sorted({path for root in roots for path in find_images(root)})
+
+    # Loaded once here; forked workers inherit the index and its cursor
+    open_ledger_index(LEDGER_PATH).refresh()
+    ledger_entries = len(open_ledger(LEDGER_PATH))
+    ledger_grew = manifest.get_meta("ledger_entries") != str(ledger_entries)
+
+    known = manifest.load()
+    summary = {"files": len(paths), "verified": 0, "cached": 0, "removed": 0, "errors": 0,
+               "ai_generated": 0, "authentic": 0, "invalid_images": 0, "tampered": 0, "not_in_ledger": 0}
+
+    def emit(record, cached):
+        result = record["result"]
+        summary["cached" if cached else "verified"] += 1
+        summary["ai_generated"] += result["is_ai_generated"]
+        summary["authentic"] += result["overall_authenticity"]
+        summary["invalid_images"] += not result["is_valid_image"]
+        summary["tampered"] += result["metadata"]["hash_found"] and not result["metadata"]["hash_valid"]
+        summary["not_in_ledger"] += needs_ledger_recheck(result)
+        if not (cached and changed_only):
+            output.write(json.dumps(audit_record(record, cached)) + "\n")
+
+    todo = []
+    for path in paths:
+        entry = known.get(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if (entry is not None and entry[:2] == (st.st_size, st.st_mtime_ns)
+                and not (ledger_grew and needs_ledger_recheck(entry[2]))):
+            emit({"path": path, "size": entry[0], "mtime_ns": entry[1], "result": entry[2]}, cached=True)
+        else:
+            todo.append(path)
+
+    if todo:
+        pending = []
+        with ProcessPoolExecutor(max_workers=workers, mp_context=verify_pool_context(),
+                                 initializer=_init_worker) as pool:
+            futures = {pool.submit(audit_file, path): path for path in todo}
+            for future in as_completed(futures):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    summary["errors"] += 1
+                    output.write(json.dumps({"path": futures[future], "error": str(e)}) + "\n")
+                    continue
+                emit(record, cached=False)
+                # Only files that could be read are remembered; the rest are retried next run
+                if record["result"]["file_exists"]:
+                    pending.append(record)
+                if len(pending) >= flush_every:
+                    manifest.put_many(pending)
+                    pending = []
+        manifest.put_many(pending)
+
+    # Forget files that were under an audited directory but are gone now
+    prefixes = tuple(os.path.join(os.path.abspath(root), "") for root in roots if os.path.isdir(root))
+    current = set(paths)
+    removed = [path for path in known if path.startswith(prefixes) and path not in current] if prefixes else []
+    manifest.remove(removed)
+    summary["removed"] = len(removed)
+
+    manifest.set_meta("ledger_entries", ledger_entries)
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    output.write(json.dumps({"summary": summary}) + "\n")
+    output.flush()
+    return summary
+
 def main():
     parser = argparse.ArgumentParser(description="Verify Image Security Features")
-    parser.add_argument("image_path", help="Path to the image to verify")
+    parser.add_argument("image_path", nargs="?", help="Image to verify, or a directory to audit every image under it")
+    parser.add_argument("--roots", help="Batch roots exported with 'ledger.py roots' (GET /ledger/roots); "
+                                        "checks the ledger entry offline")
+    parser.add_argument("--proof", help="Inclusion proof of the image (GET /ledger/proof/<TamperCheckHash>)")
+    parser.add_argument("--files-from", help="Audit the files and directories listed in this file, one per line")
+    parser.add_argument("--output", help="Bulk audit: write JSONL here instead of stdout")
+    parser.add_argument("--manifest", default=AUDIT_MANIFEST_PATH, help="Bulk audit: manifest of verified files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Bulk audit: worker processes")
+    parser.add_argument("--changed-only", action="store_true",
+                        help="Bulk audit: only output files verified in this run")
     
     args = parser.parse_args()
-    results = verify_image_security(args.image_path)
+    # Only reads the ledger: never create an empty store, read a legacy JSON ledger if that is all there is
+    open_ledger(LEDGER_PATH, create=False)
+    if args.files_from or (args.image_path and os.path.isdir(args.image_path)):
+        if args.roots:
+            parser.error("--roots needs a per-image proof and cannot be used for a bulk audit")
+        roots = [args.image_path] if args.image_path else []
+        if args.files_from:
+            with open(args.files_from, "r") as f:
+                roots.extend(line.strip() for line in f if line.strip())
+        manifest = AuditManifest(args.manifest)
+        output = open(args.output, "w") if args.output else sys.stdout
+        try:
+            summary = audit_images(roots, output, manifest, args.workers, args.changed_only)
+        finally:
+            if args.output:
+                output.close()
+        if args.output:
+            print(json.dumps({"summary": summary}), file=sys.stderr)
+        return
+    if not args.image_path:
+        parser.error("an image path, a directory or --files-from is required")
+    
+    roots = proof = None
+    if args.roots:
+        with open(args.roots, "r") as f:
+            roots = json.load(f)
+        # Accept the /ledger/roots response as well as the bare list
+        roots = roots["roots"] if isinstance(roots, dict) else roots
+        if args.proof:
+            with open(args.proof, "r") as f:
+                proof = json.load(f)
+    results = verify_image_security(args.image_path, roots, proof)
     print_verification_results(results)
 
 if __name__ == "__main__":
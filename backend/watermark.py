@@ -0,0 +1,259 @@
+import os
+import zlib
+import uuid
+import struct
+import hashlib
+from datetime import datetime, timedelta
+from functools import lru_cache
+import numpy as np
+from PIL import Image
+
+# ---------- LSB WATERMARK ENGINE ----------
+#
+# Bit layout (compatible with stegano's lsb.hide / lsb.reveal):
+#   payload bits are written MSB-first into the least significant bit of the
+#   R, G, B components of each pixel, walking pixels in row-major order.
+#   Alpha is never touched. The bit string is zero-padded to a multiple of 3.
+#
+# Two payload formats share this layout:
+#   binary (current): WATERMARK_MAGIC, version, body length, body, CRC-32
+#     body v1 = 16-byte ImageID UUID, 8-byte generation time (microseconds
+#     since 1970-01-01, wall clock), 2-byte model code; 35 bytes in total
+#   text (legacy):    "<len(message)>:<message>", one byte per character
+# The first byte tells them apart (0x89 vs an ASCII digit), so an unmarked
+# image is rejected after reading WATERMARK_HEADER_BYTES from 14 pixels.
+
+WATERMARK_MAGIC = b"\x89MW"
+WATERMARK_VERSION = 1
+WATERMARK_HEADER_BYTES = len(WATERMARK_MAGIC) + 2
+_BODY_V1 = struct.Struct(">16sQH")
+
+# Model names are stored as a 2-byte code; 0 is reserved for "unknown"
+MODEL_CODES = {
+    "stabilityai/stable-diffusion-2-1": 1,
+    "markai/tiny-random-sd": 2,
+}
+_MODEL_NAMES = {code: name for name, code in MODEL_CODES.items()}
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Longest "<digits>:" prefix we look for before giving up on a legacy text payload
+LSB_HEADER_BYTES = 16
+
+def pack_watermark(image_id, generated_at, model_id):
+    """
+    Builds a binary watermark payload. generated_at is a datetime or its
+    isoformat() string. Raises ValueError for a model without a code.
+    """
+    if model_id not in MODEL_CODES:
+        raise ValueError(f"No watermark model code for {model_id}")
+    if isinstance(generated_at, str):
+        generated_at = datetime.fromisoformat(generated_at)
+    micros = (generated_at.replace(tzinfo=None) - _EPOCH) // timedelta(microseconds=1)
+    body = _BODY_V1.pack(uuid.UUID(str(image_id)).bytes, micros, MODEL_CODES[model_id])
+    header = WATERMARK_MAGIC + bytes([WATERMARK_VERSION, len(body)])
+    return header + body + struct.pack(">I", zlib.crc32(header + body))
+
+def unpack_watermark(payload):
+    """Decodes a binary payload into {"image_id", "generated_at", "model_id", ...}."""
+    version, length = payload[len(WATERMARK_MAGIC)], payload[len(WATERMARK_MAGIC) + 1]
+    body = payload[WATERMARK_HEADER_BYTES:WATERMARK_HEADER_BYTES + length]
+    crc = payload[WATERMARK_HEADER_BYTES + length:WATERMARK_HEADER_BYTES + length + 4]
+    if len(crc) != 4 or struct.unpack(">I", crc)[0] != zlib.crc32(payload[:WATERMARK_HEADER_BYTES + length]):
+        raise ValueError("Watermark checksum mismatch")
+    if version != WATERMARK_VERSION or length != _BODY_V1.size:
+        raise ValueError(f"Unsupported watermark version: {version}")
+    raw_id, micros, model_code = _BODY_V1.unpack(body)
+    return {
+        "format": "binary",
+        "version": version,
+        "image_id": str(uuid.UUID(bytes=raw_id)),
+        "generated_at": (_EPOCH + timedelta(microseconds=micros)).isoformat(),
+        "model_code": model_code,
+        "model_id": _MODEL_NAMES.get(model_code),
+    }
+
+def watermark_message(watermark):
+    """The human-readable message of a revealed watermark (as in the text format)."""
+    if watermark["format"] == "text":
+        return watermark["message"]
+    model = watermark["model_id"] or f"model-{watermark['model_code']}"
+    return f"{model} {watermark['image_id']} - {watermark['generated_at']}"
+
+def _lsb_payload(message):
+    """Builds the length-prefixed payload bytes for a text message."""
+    if not message:
+        raise ValueError("Watermark message is empty")
+    try:
+        return f"{len(message)}:{message}".encode("latin-1")
+    except UnicodeEncodeError:
+        raise ValueError("Watermark message must only contain 8-bit characters")
+
+def _rgb_components(pixels, n_pixels):
+    """Returns a (n_pixels, 3) view of the RGB components of the first pixels."""
+    return pixels.reshape(-1, pixels.shape[-1])[:n_pixels, :3]
+
+def lsb_hide(image, message):
+    """
+    Hides message in the LSBs of the image's RGB components. message is a
+    packed binary payload (bytes, see pack_watermark) or legacy text (str).
+    Returns a new image; the input image is left untouched.
+    """
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGB")
+
+    payload = bytes(message) if isinstance(message, (bytes, bytearray)) else _lsb_payload(message)
+    bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8))
+    n_pixels = -(-bits.size // 3)
+    if n_pixels > image.width * image.height:
+        raise ValueError(f"The message you want to hide is too long: {len(message)}")
+    bits = np.pad(bits, (0, n_pixels * 3 - bits.size)).reshape(n_pixels, 3)
+
+    pixels = np.array(image)
+    target = _rgb_components(pixels, n_pixels)
+    target &= 0xFE
+    target |= bits
+
+    return Image.fromarray(pixels, mode=image.mode)
+
+def _read_lsb_bytes(image, n_bytes):
+    """Reads n_bytes of LSB data, copying only the pixel rows that hold them."""
+    n_pixels = -(-n_bytes * 8 // 3)
+    rows = -(-n_pixels // image.width)
+    pixels = np.asarray(image.crop((0, 0, image.width, rows)))
+    bits = _rgb_components(pixels, n_pixels).reshape(-1)[:n_bytes * 8] & 1
+    return np.packbits(bits).tobytes()
+
+def watermark_reveal(image):
+    """
+    Reads the watermark of an image in either format. Returns a dict with
+    "format" ("binary" or "text"); raises ValueError if there is none.
+    """
+    if image.mode not in ("RGB", "RGBA"):
+        raise ValueError(f"Unsupported image mode for LSB watermark: {image.mode}")
+
+    capacity = image.width * image.height * 3 // 8
+    if capacity < WATERMARK_HEADER_BYTES:
+        raise ValueError("Impossible to detect message.")
+
+    # The fixed-size header decides the format, or rejects the image
+    header = _read_lsb_bytes(image, WATERMARK_HEADER_BYTES)
+    if header.startswith(WATERMARK_MAGIC):
+        total = WATERMARK_HEADER_BYTES + header[-1] + 4
+        if total > capacity:
+            raise ValueError("Impossible to detect message.")
+        return unpack_watermark(_read_lsb_bytes(image, total))
+    if not header[:1].isdigit():
+        raise ValueError("Impossible to detect message.")
+    return {"format": "text", "message": _reveal_text(image, capacity)}
+
+def _reveal_text(image, capacity):
+    """Reads a legacy "<len>:<message>" payload."""
+    # Only the first few pixels are needed to find the length prefix
+    header = _read_lsb_bytes(image, min(LSB_HEADER_BYTES, capacity))
+    separator = header.find(b":")
+    if separator <= 0 or not header[:separator].isdigit():
+        raise ValueError("Impossible to detect message.")
+
+    length = int(header[:separator])
+    total = separator + 1 + length
+    if total > capacity:
+        raise ValueError("Impossible to detect message.")
+
+    payload = header if total <= len(header) else _read_lsb_bytes(image, total)
+    return payload[separator + 1:total].decode("latin-1")
+
+def lsb_reveal(image):
+    """
+    Reads the message hidden with lsb_hide (or stegano's lsb.hide); binary
+    payloads are rendered as the equivalent text message.
+    Raises ValueError if the image does not carry a readable message.
+    """
+    return watermark_message(watermark_reveal(image))
+
+# ---------- FREQUENCY-DOMAIN WATERMARK ENGINE ----------
+#
+# A keyed +/-1 spread-spectrum sequence is added to mid-frequency coefficients
+# of the 8x8 block DCT of the luminance channel, computed on a fixed
+# DCT_SIZE x DCT_SIZE analysis grid. The resulting spatial pattern is scaled up
+# to the image size and added equally to R, G and B. Detection scales the
+# luminance back down to the analysis grid and correlates once, so it costs
+# the same for any upload size and survives lossy re-encoding and resizing.
+
+DCT_SIZE = 256
+DCT_BLOCK = 8
+DCT_STRENGTH = float(os.environ.get("DCT_WATERMARK_STRENGTH", 3.0))
+# Unmarked images score ~N(0, 1) (max 3.1 over 3000 natural photos), so a
+# threshold of 8 puts false positives near 1e-15 per image; marked images
+# score 55-110, even after JPEG q50 or a 0.5x resize
+DCT_THRESHOLD = 8.0
+WATERMARK_KEY = os.environ.get("WATERMARK_KEY", "markai")
+
+# Mid-frequency band: survives JPEG quantisation without being visible
+DCT_BAND = [(u, v) for u in range(DCT_BLOCK) for v in range(DCT_BLOCK) if 3 <= u + v <= 6]
+
+def dct_matrix(n=DCT_BLOCK):
+    """Orthonormal DCT-II basis matrix."""
+    k = np.arange(n)
+    basis = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    basis[0] /= np.sqrt(2)
+    return basis
+
+_DCT = dct_matrix()
+_BAND_U = np.array([u for u, _ in DCT_BAND])
+_BAND_V = np.array([v for _, v in DCT_BAND])
+
+def _spread_sequence(key):
+    """Keyed +/-1 sequence with one value per block and band coefficient."""
+    seed = int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+    blocks = DCT_SIZE // DCT_BLOCK
+    return np.random.default_rng(seed).choice([-1.0, 1.0], size=(blocks, blocks, len(DCT_BAND)))
+
+@lru_cache(maxsize=8)
+def _spatial_pattern(key, strength, width, height):
+    """The watermark as a luminance offset at the image's own size."""
+    blocks = DCT_SIZE // DCT_BLOCK
+    coefficients = np.zeros((blocks, blocks, DCT_BLOCK, DCT_BLOCK))
+    coefficients[:, :, _BAND_U, _BAND_V] = strength * _spread_sequence(key)
+
+    # Inverse block DCT of every block at once, then reassemble the grid
+    spatial = np.einsum("ui,abuv,vj->aibj", _DCT, coefficients, _DCT).reshape(DCT_SIZE, DCT_SIZE)
+    if (width, height) != (DCT_SIZE, DCT_SIZE):
+        spatial = np.asarray(Image.fromarray(spatial.astype(np.float32), mode="F").resize(
+            (width, height), Image.BILINEAR))
+    return spatial.astype(np.float32)
+
+def _analysis_luminance(image):
+    """Luminance on the DCT_SIZE x DCT_SIZE analysis grid."""
+    # Lets JPEG uploads decode straight at a reduced scale when not yet loaded
+    image.draft("L", (DCT_SIZE, DCT_SIZE))
+    luminance = image.convert("L") if image.mode != "L" else image
+    return np.asarray(luminance.resize((DCT_SIZE, DCT_SIZE), Image.BOX), dtype=np.float32)
+
+def dct_embed(image, key=WATERMARK_KEY, strength=DCT_STRENGTH):
+    """Adds the keyed frequency-domain watermark; returns a new RGB image."""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    pattern = _spatial_pattern(key, strength, image.width, image.height)
+    pixels = np.asarray(image, dtype=np.float32) + pattern[:, :, None]
+    return Image.fromarray(np.clip(np.rint(pixels), 0, 255).astype(np.uint8), mode="RGB")
+
+def dct_detect(image, key=WATERMARK_KEY):
+    """
+    Correlates the image's block-DCT band with the keyed sequence.
+    Returns (detected, score); score is a z-score, ~0 for unmarked images.
+    An image that is not loaded yet is decoded at reduced scale where the
+    format allows it (JPEG), so load it first if its full pixels are needed.
+    """
+    blocks = DCT_SIZE // DCT_BLOCK
+    luminance = _analysis_luminance(image).reshape(blocks, DCT_BLOCK, blocks, DCT_BLOCK)
+    coefficients = np.einsum("ui,aibj,vj->abuv", _DCT, luminance, _DCT)[:, :, _BAND_U, _BAND_V]
+
+    # Normalise per band coefficient so no single frequency dominates
+    coefficients = coefficients - coefficients.mean(axis=(0, 1))
+    spread = coefficients.std(axis=(0, 1))
+    spread[spread == 0] = 1.0
+    samples = (coefficients / spread) * _spread_sequence(key)
+
+    score = float(samples.sum() / np.sqrt(samples.size))
+    return score >= DCT_THRESHOLD, score